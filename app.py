@@ -2,9 +2,19 @@ import os
 import re
 import json
 import time
+import random
+import hashlib
+import importlib.util
+import threading
+import traceback
+import stat
+import struct
 import xml.etree.ElementTree as ET
+from functools import lru_cache
 from pathlib import Path
-from io import BytesIO
+from collections import OrderedDict, defaultdict, deque
+from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 # ── PDF ──────────────────────────────────────────────────────────────
 from reportlab.platypus import (
@@ -20,52 +30,94 @@ from reportlab.lib.colors import HexColor, black, white
 from reportlab.lib.units import mm
 
 # ── Flask ────────────────────────────────────────────────────────────
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import (Flask, Response, render_template, request, send_file,
+                   stream_with_context)
 
 # ── Gemini ───────────────────────────────────────────────────────────
+# The SDK (and its gRPC/protobuf stack) is only imported on first use, so
+# workers that never reach Gemini don't pay for it at startup.
 try:
-    import google.generativeai as genai
-    GENAI_AVAILABLE = True
+    GENAI_AVAILABLE = importlib.util.find_spec("google.generativeai") is not None
 except Exception:
-    genai = None
     GENAI_AVAILABLE = False
+genai = None
+
+def _ensure_genai():
+    global genai
+    if genai is None:
+        import google.generativeai as genai
+    return genai
+
+# ── JSON (orjson when installed: C-speed, emits bytes directly) ─────
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except Exception:
+    orjson = None
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    _json_loads = json.loads
+
+# ── Redis (optional shared cache; only used when REDIS_URL is set) ──
+_REDIS = None
+if os.environ.get("REDIS_URL"):
+    try:
+        import redis
+        _REDIS = redis.Redis.from_url(os.environ["REDIS_URL"], decode_responses=True,
+                                      socket_timeout=0.5, socket_connect_timeout=0.5)
+    except Exception:
+        _REDIS = None
 
 app = Flask(__name__, template_folder="templates",
             static_folder="static", static_url_path="/static")
 
 GEMINI_KEY = os.environ.get("GEMINI_API_KEY", "").strip()
+_GEMINI_READY = bool(GEMINI_KEY and GENAI_AVAILABLE)
 
 # ═══════════════════════════════════════════════════════════════════════
 # LOAD EXAM PATTERN DATA
 # ═══════════════════════════════════════════════════════════════════════
-_DATA_DIR = Path(os.path.dirname(os.path.abspath(__file__))) / "data"
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+_DATA_DIR = Path(_BASE_DIR) / "data"
 
 def _load_json(name):
     p = _DATA_DIR / name
     if p.exists():
-        with open(p, encoding="utf-8") as f:
-            return json.load(f)
+        return _json_loads(p.read_bytes())
     return {}
 
 _PATTERN_AP_TS    = _load_json("exam_patterns/ap_ts.json")
 _PATTERN_COMP     = _load_json("exam_patterns/competitive.json")
 _CURRICULUM       = _load_json("curriculum.json")
 
+# Curriculum is static for the process lifetime, so one validator covers
+# every /chapters response (whole dump and per-class slices alike).
+_CURRICULUM_ETAG  = hashlib.sha1(
+    json.dumps(_CURRICULUM, sort_keys=True).encode("utf-8")).hexdigest()
+
+# /chapters bodies, serialised once: key None is the whole dump, the rest
+# are per-class slices.
+def _chapters_body(data):
+    return _json_dumps({"success": True, "data": data})
+
+_CHAPTERS_BODY = {None: _chapters_body(_CURRICULUM)}
+_CHAPTERS_BODY.update({cls: _chapters_body(v) for cls, v in _CURRICULUM.items()})
+
 # ═══════════════════════════════════════════════════════════════════════
 # FONT REGISTRATION
 # ═══════════════════════════════════════════════════════════════════════
 _fonts_registered = False
+_FONT_DIRS = (os.path.join(_BASE_DIR, "static", "fonts"),
+              "/usr/share/fonts/truetype/dejavu")
 
 def register_fonts():
     global _fonts_registered
     if _fonts_registered:
         return
-    _base = os.path.dirname(os.path.abspath(__file__))
-    fdir  = os.path.join(_base, "static", "fonts")
-    sys_d = "/usr/share/fonts/truetype/dejavu"
 
     def reg(name, filename):
-        for d in [fdir, sys_d]:
+        for d in _FONT_DIRS:
             p = os.path.join(d, filename)
             if os.path.exists(p):
                 try:
@@ -80,14 +132,25 @@ def register_fonts():
     reg("Ital", "DejaVuSans-Oblique.ttf")
     _fonts_registered = True
 
+# Register once at import so the TTF files are parsed before the first
+# request rather than inside it.
+register_fonts()
+
+# Resolved font name per variant — fixed once registration has run.
+_F_CACHE = {}
+
 def _f(variant="Reg"):
-    register_fonts()
-    fallback = {"Reg": "Helvetica", "Bold": "Helvetica-Bold", "Ital": "Helvetica-Oblique"}
-    try:
-        pdfmetrics.getFont(variant)
-        return variant
-    except Exception:
-        return fallback.get(variant, "Helvetica")
+    name = _F_CACHE.get(variant)
+    if name is None:
+        register_fonts()
+        fallback = {"Reg": "Helvetica", "Bold": "Helvetica-Bold", "Ital": "Helvetica-Oblique"}
+        try:
+            pdfmetrics.getFont(variant)
+            name = variant
+        except Exception:
+            name = fallback.get(variant, "Helvetica")
+        _F_CACHE[variant] = name
+    return name
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -169,34 +232,66 @@ _SYM = {
 
 
 def _extract_braced(s, pos):
-    if pos >= len(s) or s[pos] != '{':
-        return (s[pos], pos + 1) if pos < len(s) else ('', pos)
-    depth, i = 0, pos
-    while i < len(s):
-        if   s[i] == '{': depth += 1
-        elif s[i] == '}': depth -= 1
+    n = len(s)
+    if pos >= n or s[pos] != '{':
+        return (s[pos], pos + 1) if pos < n else ('', pos)
+    # Jump from brace to brace with str.find rather than stepping through
+    # every character: the loop runs once per brace, not once per char.
+    depth = 1
+    op = s.find('{', pos + 1)
+    cl = s.find('}', pos + 1)
+    while cl != -1:
+        while op != -1 and op < cl:
+            depth += 1
+            op = s.find('{', op + 1)
+        depth -= 1
         if depth == 0:
-            return s[pos+1:i], i+1
-        i += 1
-    return s[pos+1:], len(s)
-
-
+            return s[pos+1:cl], cl + 1
+        cl = s.find('}', cl + 1)
+    return s[pos+1:], n
+
+
+# All Greek/symbol commands in one alternation, longest first so \leq wins
+# over \le and \infty over \in — a single scan instead of one replace()
+# pass per table entry.
+_LATEX_CMD_MAP = {**_GREEK, **_SYM}
+_LATEX_CMD_RE  = re.compile('|'.join(
+    map(re.escape, sorted(_LATEX_CMD_MAP, key=len, reverse=True))))
+
+def _latex_cmd_repl(m):
+    return _LATEX_CMD_MAP[m.group(0)]
+
+_XML_TRANS = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+_LATEX_SPECIAL_RE = re.compile(r'[\\^_]')
+_TEXT_CMD_RE   = re.compile(r'\\(?:text|mathrm|mathbf|mathit|boldsymbol)\{([^}]*)\}')
+_LEFT_RIGHT_RE = re.compile(r'\\(?:left|right)(?=[|(\[\]{}.])')
+_MULTISPACE_RE = re.compile(r'  +')
+
+# _latex_to_rl and _process are pure string transforms. Math fragments
+# and stock phrases recur across questions and across papers, so both
+# are memoised (nested spans hit the cache on recursion too).
+@lru_cache(maxsize=4096)
 def _latex_to_rl(expr: str) -> str:
     s = expr.strip().lstrip('$').rstrip('$').strip()
-    s = re.sub(r'\\(?:text|mathrm|mathbf|mathit|boldsymbol)\{([^}]*)\}', r'\1', s)
-    s = re.sub(r'\\(?:left|right)(?=[|(\[\]{}.])', '', s)
-    for k in sorted(_GREEK, key=len, reverse=True):
-        s = s.replace(k, _GREEK[k])
-    for k in sorted(_SYM, key=len, reverse=True):
-        s = s.replace(k, _SYM[k])
-
-    result, i = '', 0
-    while i < len(s):
+    s = _TEXT_CMD_RE.sub(r'\1', s)
+    s = _LEFT_RIGHT_RE.sub('', s)
+    s = _LATEX_CMD_RE.sub(_latex_cmd_repl, s)
+
+    out, i, n = [], 0, len(s)
+    while i < n:
+        if s[i] not in '\\^_':
+            # Plain text up to the next command or script marker is copied
+            # as one slice instead of one character per iteration.
+            m = _LATEX_SPECIAL_RE.search(s, i)
+            j = m.start() if m else n
+            out.append(s[i:j].translate(_XML_TRANS))
+            i = j
+            continue
         if s[i:i+5] == '\\frac':
             i += 5
             num, i = _extract_braced(s, i)
             den, i = _extract_braced(s, i)
-            result += f'({_latex_to_rl(num)}/{_latex_to_rl(den)})'
+            out.append(f'({_latex_to_rl(num)}/{_latex_to_rl(den)})')
             continue
         if s[i:i+5] == '\\sqrt':
             i += 5
@@ -205,26 +300,26 @@ def _latex_to_rl(expr: str) -> str:
                 j = s.find(']', i); j = j if j != -1 else i
                 n_root = s[i+1:j];  i = j + 1
             inner, i = _extract_braced(s, i)
-            result += f'{n_root}√({_latex_to_rl(inner)})'
+            out.append(f'{n_root}√({_latex_to_rl(inner)})')
             continue
         if s[i] == '^':
             i += 1
             raw, i = _extract_braced(s, i)
-            inner = _latex_to_rl(raw).replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
-            result += f'<super>{inner}</super>'
+            inner = _latex_to_rl(raw).translate(_XML_TRANS)
+            out.append(f'<super>{inner}</super>')
             continue
         if s[i] == '_':
             i += 1
             raw, i = _extract_braced(s, i)
-            inner = _latex_to_rl(raw).replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
-            result += f'<sub>{inner}</sub>'
+            inner = _latex_to_rl(raw).translate(_XML_TRANS)
+            out.append(f'<sub>{inner}</sub>')
             continue
         decorated = False
         for cmd in (r'\overline', r'\widehat', r'\widetilde', r'\vec', r'\hat', r'\bar', r'\tilde'):
             if s[i:].startswith(cmd):
                 i += len(cmd)
                 inner, i = _extract_braced(s, i)
-                result += _latex_to_rl(inner)
+                out.append(_latex_to_rl(inner))
                 decorated = True
                 break
         if decorated:
@@ -236,41 +331,52 @@ def _latex_to_rl(expr: str) -> str:
             if j == i + 1 and j < len(s):
                 j += 1
             i = j
-            result += ' '
+            out.append(' ')
             continue
-        c = s[i]
-        if   c == '&': result += '&amp;'
-        elif c == '<': result += '&lt;'
-        elif c == '>': result += '&gt;'
-        else:          result += c
-        i += 1
-    return re.sub(r'  +', ' ', result).strip()
+    return _MULTISPACE_RE.sub(' ', ''.join(out)).strip()
+
+
+_TAG_RE     = re.compile(r'(</?(?:super|sub|b|i|font)[^>]*>)')
+_AMP_FIX_RE = re.compile(r'&amp;(amp|lt|gt|quot|#\d+);')
+_BOLD_RE    = re.compile(r'\*\*(.+?)\*\*')
+_ITALIC_RE  = re.compile(r'\*(.+?)\*')
 
+def _math_repl(m):
+    return _latex_to_rl(m.group(0))
 
+@lru_cache(maxsize=4096)
 def _process(text: str) -> str:
-    text = re.sub(r'\\_', '_', text)
-    text = re.sub(r'\\-',  '-', text)
-    text = re.sub(r'\\%',  '%', text)
-
-    def _repl(m):
-        return _latex_to_rl(m.group(0))
-    converted = _MATH_RE.sub(_repl, text)
-
-    tag_re = re.compile(r'(</?(?:super|sub|b|i|font)[^>]*>)')
-    parts  = tag_re.split(converted)
-    safe   = []
-    for p in parts:
-        if tag_re.match(p):
-            safe.append(p)
-        else:
-            p = p.replace('&', '&amp;')
-            p = re.sub(r'&amp;(amp|lt|gt|quot|#\d+);', r'&\1;', p)
-            p = re.sub(r'<', '&lt;', p)
-            safe.append(p)
-
-    out = ''.join(safe)
-    out = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', out)
-    out = re.sub(r'\*(.+?)\*',     r'<i>\1</i>', out)
+    # Each stage is skipped when its trigger character is absent — most
+    # lines are plain prose with no escapes, math, markup or XML specials.
+    if '\\' in text:
+        text = text.replace('\\_', '_').replace('\\-', '-').replace('\\%', '%')
+
+    # A math span needs an opening and a closing '$'.
+    converted = _MATH_RE.sub(_math_repl, text) if text.count('$') >= 2 else text
+
+    if '<' in converted or '&' in converted:
+        parts  = _TAG_RE.split(converted)
+        safe   = []
+        for p in parts:
+            if _TAG_RE.match(p):
+                safe.append(p)
+            else:
+                if '&' in p:
+                    p = p.replace('&', '&amp;')
+                    p = _AMP_FIX_RE.sub(r'&\1;', p)
+                if '<' in p:
+                    p = p.replace('<', '&lt;')
+                safe.append(p)
+        out = ''.join(safe)
+    else:
+        out = converted
+
+    # Bold runs first so '**' is never read as two italic markers; the
+    # italic pass is skipped when bold consumed every '*'.
+    if '*' in out:
+        out = _BOLD_RE.sub(r'<b>\1</b>', out)
+        if '*' in out:
+            out = _ITALIC_RE.sub(r'<i>\1</i>', out)
     return out
 
 
@@ -290,10 +396,16 @@ C_KFILL = HexColor("#f8f8f8")   # Answer key background
 C_STEP  = HexColor("#1a1a1a")   # Key steps
 C_HDR   = HexColor("#000000")   # Header (unused but keep for compat)
 
+# Hex strings for inline <font color=…> markup, formatted once.
+_HEX = {"STEEL": C_STEEL.hexval(), "GREY": C_GREY.hexval(), "MARK": C_MARK.hexval()}
+
 
 # ═══════════════════════════════════════════════════════════════════════
 # STYLES
 # ═══════════════════════════════════════════════════════════════════════
+# Paragraph styles are only read during a build, so one sheet is shared
+# by every PDF.
+@lru_cache(maxsize=None)
 def _styles():
     register_fonts()
     R, B, I = _f("Reg"), _f("Bold"), _f("Ital")
@@ -370,87 +482,178 @@ class ExamCanvas:
 # ═══════════════════════════════════════════════════════════════════════
 # HELPERS
 # ═══════════════════════════════════════════════════════════════════════
+# ── Shared table styles ───────────────────────────────────────────────
+# TableStyle objects are read-only once built; setStyle() copies their
+# commands into each table, so one instance serves every PDF.
+_SEC_BANNER_STYLE = TableStyle([
+    ("BACKGROUND",    (0,0),(-1,-1), HexColor("#f2f2f2")),
+    ("LINEBELOW",     (0,0),(-1,-1), 0.8, HexColor("#111111")),
+    ("LINETOP",       (0,0),(-1,-1), 0.8, HexColor("#111111")),
+    ("LEFTPADDING",   (0,0),(-1,-1), 8),
+    ("RIGHTPADDING",  (0,0),(-1,-1), 8),
+    ("TOPPADDING",    (0,0),(-1,-1), 4),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 4),
+])
+_HEADER_TITLE_STYLE = TableStyle([
+    ("BACKGROUND",    (0,0),(-1,-1), white),
+    ("LINEBELOW",     (0,0),(-1,-1), 1.5, black),
+    ("LINETOP",       (0,0),(-1,-1), 1.5, black),
+    ("TOPPADDING",    (0,0),(-1,-1), 6),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 6),
+    ("LEFTPADDING",   (0,0),(-1,-1), 0),
+    ("RIGHTPADDING",  (0,0),(-1,-1), 0),
+])
+_HEADER_META_STYLE = TableStyle([
+    ("BACKGROUND",    (0,0),(-1,-1), white),
+    ("LINEBELOW",     (0,0),(-1,-1), 0.6, HexColor("#888888")),
+    ("TOPPADDING",    (0,0),(-1,-1), 3),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 4),
+    ("LEFTPADDING",   (0,0),(-1,-1), 0),
+    ("RIGHTPADDING",  (0,0),(-1,-1), 0),
+    ("VALIGN",        (0,0),(-1,-1), "MIDDLE"),
+])
+_DIAGRAM_BOX_STYLE = TableStyle([
+    ('BOX',           (0,0),(-1,-1), 0.6, C_RULE),
+    ('BACKGROUND',    (0,0),(-1,-1), HexColor('#f9f9f9')),
+    ('TOPPADDING',    (0,0),(-1,-1), 6),
+    ('BOTTOMPADDING', (0,0),(-1,-1), 6),
+    ('LEFTPADDING',   (0,0),(-1,-1), 10),
+    ('RIGHTPADDING',  (0,0),(-1,-1), 10),
+    ('VALIGN',        (0,0),(-1,-1), 'TOP'),
+])
+_KEY_TITLE_STYLE = TableStyle([
+    ("BACKGROUND",    (0,0),(-1,-1), C_KFILL),
+    ("LINEBELOW",     (0,0),(-1,-1), 2.0, black),
+    ("LINETOP",       (0,0),(-1,-1), 2.0, black),
+    ("TOPPADDING",    (0,0),(-1,-1), 8),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 8),
+])
+_KEY_SEC_STYLE = TableStyle([
+    ("BACKGROUND",    (0,0),(-1,-1), HexColor("#f0f0f0")),
+    ("LINEBELOW",     (0,0),(-1,-1), 0.8, HexColor("#111111")),
+    ("LEFTPADDING",   (0,0),(-1,-1), 10),
+    ("TOPPADDING",    (0,0),(-1,-1), 4),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 4),
+])
+_PIPE_TABLE_STYLE = TableStyle([
+    ("FONTNAME",       (0,0),(-1,-1), _f("Reg")),
+    ("FONTSIZE",       (0,0),(-1,-1), 9.5),
+    ("BACKGROUND",     (0,0),(-1,0),  HexColor("#e8e8e8")),
+    ("TEXTCOLOR",      (0,0),(-1,0),  black),
+    ("FONTNAME",       (0,0),(-1,0),  _f("Bold")),
+    ("GRID",           (0,0),(-1,-1), 0.5, HexColor("#aaaaaa")),
+    ("ROWBACKGROUNDS", (0,1),(-1,-1), [white, HexColor("#f8f8f8")]),
+    ("TOPPADDING",     (0,0),(-1,-1), 4),
+    ("BOTTOMPADDING",  (0,0),(-1,-1), 4),
+    ("LEFTPADDING",    (0,0),(-1,-1), 7),
+    ("RIGHTPADDING",   (0,0),(-1,-1), 7),
+    ("VALIGN",         (0,0),(-1,-1), "MIDDLE"),
+])
+_OPTS_TABLE_STYLE = TableStyle([
+    ("TOPPADDING",    (0,0),(-1,-1), 1),
+    ("BOTTOMPADDING", (0,0),(-1,-1), 1),
+    ("LEFTPADDING",   (0,0),(-1,-1), 20),
+    ("RIGHTPADDING",  (0,0),(-1,-1), 4),
+    ("VALIGN",        (0,0),(-1,-1), "TOP"),
+])
+_DIAGRAM_OUTER_STYLE = TableStyle([
+    ('ALIGN',         (0,0),(-1,-1), 'CENTER'),
+    ('TOPPADDING',    (0,0),(-1,-1), 2),
+    ('BOTTOMPADDING', (0,0),(-1,-1), 2),
+])
+_PLACEHOLDER_OUTER_STYLE = TableStyle([
+    ('ALIGN',         (0,0),(-1,-1), 'CENTER'),
+    ('TOPPADDING',    (0,0),(-1,-1), 2),
+    ('BOTTOMPADDING', (0,0),(-1,-1), 4),
+])
+
+
 def _sec_banner(text, st, pw):
     p = Paragraph(f'<b>{text}</b>', st["SecBanner"])
     t = Table([[p]], colWidths=[pw])
-    t.setStyle(TableStyle([
-        ("BACKGROUND",    (0,0),(-1,-1), HexColor("#f2f2f2")),
-        ("LINEBELOW",     (0,0),(-1,-1), 0.8, HexColor("#111111")),
-        ("LINETOP",       (0,0),(-1,-1), 0.8, HexColor("#111111")),
-        ("LEFTPADDING",   (0,0),(-1,-1), 8),
-        ("RIGHTPADDING",  (0,0),(-1,-1), 8),
-        ("TOPPADDING",    (0,0),(-1,-1), 4),
-        ("BOTTOMPADDING", (0,0),(-1,-1), 4),
-    ]))
+    t.setStyle(_SEC_BANNER_STYLE)
     return t
 
 
 def _opts_table(opts, st, pw):
-    rows = []
-    for k in range(0, len(opts), 2):
-        L = opts[k]
-        R = opts[k+1] if k+1 < len(opts) else ('', '')
-        lp = Paragraph(f'<b>({L[0]})</b>  {L[1]}', st["Opt"])
-        rp = Paragraph(f'<b>({R[0]})</b>  {R[1]}' if R[0] else '', st["Opt"])
-        rows.append([lp, rp])
+    sty = st["Opt"]
+    if len(opts) % 2:
+        opts = opts + [('', '')]
+    rows = [[Paragraph(f'<b>({L[0]})</b>  {L[1]}', sty),
+             Paragraph(f'<b>({R[0]})</b>  {R[1]}' if R[0] else '', sty)]
+            for L, R in zip(opts[::2], opts[1::2])]
     col = pw / 2
     t = Table(rows, colWidths=[col, col])
-    t.setStyle(TableStyle([
-        ("TOPPADDING",    (0,0),(-1,-1), 1),
-        ("BOTTOMPADDING", (0,0),(-1,-1), 1),
-        ("LEFTPADDING",   (0,0),(-1,-1), 20),
-        ("RIGHTPADDING",  (0,0),(-1,-1), 4),
-        ("VALIGN",        (0,0),(-1,-1), "TOP"),
-    ]))
+    t.setStyle(_OPTS_TABLE_STYLE)
     return t
 
 
-def _pipe_table(rows, st, pw):
+# ~38 mm reserved for a hand-drawn diagram, less the label row.
+_PLACEHOLDER_SPACER_H = 38 * mm - 20
+
+def _placeholder(desc, st, pw):
+    # Clean placeholder box — no stray text inside, just a neat space
+    ph_label = Paragraph(f'<i>[ Draw diagram here: {desc} ]</i>', st["DiagLabel"])
+    box = Table([[ph_label], [Spacer(1, _PLACEHOLDER_SPACER_H)]], colWidths=[pw * 0.72])
+    box.setStyle(_DIAGRAM_BOX_STYLE)
+    outer = Table([[box]], colWidths=[pw])
+    outer.setStyle(_PLACEHOLDER_OUTER_STYLE)
+    return outer
+
+
+def _pipe_table(rows, st, pw, mc=0):
     if not rows:
         return None
-    mc = max(len(r) for r in rows)
-    norm = [r + ['']*(mc-len(r)) for r in rows]
-    R, B = _f("Reg"), _f("Bold")
+    mc = mc or max(len(r) for r in rows)
 
+    # Short rows are padded in the same pass, with one shared blank cell
+    # per style instead of a converted '' per missing column.
+    head, body = st["KQ"], st["KStep"]
+    blank = {}
     para_rows = []
-    for ri, row in enumerate(norm):
-        sty = st["KQ"] if ri == 0 else st["KStep"]
-        para_rows.append([Paragraph(_process(c), sty) for c in row])
+    for ri, row in enumerate(rows):
+        sty = head if ri == 0 else body
+        para = [Paragraph(_process(c), sty) for c in row]
+        if len(para) < mc:
+            if sty.name not in blank:
+                blank[sty.name] = Paragraph(_process(''), sty)
+            para.extend([blank[sty.name]] * (mc - len(para)))
+        para_rows.append(para)
 
     cw = pw / mc
     t = Table(para_rows, colWidths=[cw]*mc, repeatRows=1)
-    t.setStyle(TableStyle([
-        ("FONTNAME",       (0,0),(-1,-1), R),
-        ("FONTSIZE",       (0,0),(-1,-1), 9.5),
-        ("BACKGROUND",     (0,0),(-1,0),  HexColor("#e8e8e8")),
-        ("TEXTCOLOR",      (0,0),(-1,0),  black),
-        ("FONTNAME",       (0,0),(-1,0),  B),
-        ("GRID",           (0,0),(-1,-1), 0.5, HexColor("#aaaaaa")),
-        ("ROWBACKGROUNDS", (0,1),(-1,-1), [white, HexColor("#f8f8f8")]),
-        ("TOPPADDING",     (0,0),(-1,-1), 4),
-        ("BOTTOMPADDING",  (0,0),(-1,-1), 4),
-        ("LEFTPADDING",    (0,0),(-1,-1), 7),
-        ("RIGHTPADDING",   (0,0),(-1,-1), 7),
-        ("VALIGN",         (0,0),(-1,-1), "MIDDLE"),
-    ]))
+    t.setStyle(_PIPE_TABLE_STYLE)
     return t
 
 
 # ═══════════════════════════════════════════════════════════════════════
 # LINE-TYPE DETECTORS
 # ═══════════════════════════════════════════════════════════════════════
-def _is_sec_hdr(s):
-    s = s.strip()
-    if re.match(r'^(SECTION|Section|PART|Part)\s+[A-Da-d](\s|[-:]|$)', s):
-        return True
-    return bool(re.match(r'^(GENERAL INSTRUCTIONS|General Instructions'
-                         r'|Instructions|Note:|NOTE:)\s*$', s))
-
-def _is_table_row(s):
-    return '|' in s and s.strip().startswith('|')
-
-def _is_divider(s):
-    return bool(re.match(r'^\|[\s\-:|]+\|', s.strip()))
+_SEC_HDR_RE   = re.compile(r'^(SECTION|Section|PART|Part)\s+[A-Da-d](\s|[-:]|$)')
+_INSTR_HDR_RE = re.compile(r'^(GENERAL INSTRUCTIONS|General Instructions'
+                           r'|Instructions|Note:|NOTE:)\s*$')
+_GEN_INSTR_RE = re.compile(r'^(GENERAL INSTRUCTIONS|General Instructions'
+                           r'|Instructions)\s*$')
+_DIVIDER_RE   = re.compile(r'^\|[\s\-:|]+\|')
+_NUM_ITEM_RE  = re.compile(r'^\d+\.\s+')
+_QLINE_RE     = re.compile(r'^(Q\.?\s*)?(\d+)[\.)\]]\s+(.+)')
+# Answer-key lines: section header, question, sub-part — one match
+# classifies the line, tried in that order; m.lastgroup names the branch
+# ('sec', 'qbody' or 'sbody').
+_KEY_LINE_RE  = re.compile(
+    r'(?P<sec>(?:Section|SECTION|Part|PART)\s+[A-Da-d]\b)'
+    r'|(?:Q\.?\s*)?(?P<qnum>\d+)[\.)\]]\s*(?P<qbody>.*)'
+    r'|\(?(?P<sl>[a-z])\)\.?\s+(?P<sbody>.+)')
+# Characters a _KEY_LINE_RE match can start with (plus any \d, tested via
+# str.isdecimal()); working steps starting with '=', '∴', '$' or a
+# capital skip the regex on a set lookup.
+_KEY_LINE_PREFIX = frozenset('SPQ(abcdefghijklmnopqrstuvwxyz')
+_QNUM_RE      = re.compile(r'^(Q\.?\s*)?\d+[\.)\]]\s')
+_OPT_RE       = re.compile(r'^\s*[\(\[]\s*([a-dA-D])\s*[\)\]\.]?\s+(.+)')
+_MULTI_OPT_RE = re.compile(
+    r'[\(\[]([a-dA-D])[\)\]\.]?\s+([^(\[]+?)(?=\s*[\(\[][a-dA-D][\)\]\.]|$)')
+_SUB_RE       = re.compile(r'^\s*[\(\[]\s*([a-z])\s*[\)\]]\s+(.+)')
+_MARK_TAG_RE  = re.compile(r'(\[\s*(\d+)\s*[Mm]arks?\s*\])\s*$')   # 1: tag, 2: number
 
 def _is_hrule(s):
     s = s.strip()
@@ -495,6 +698,52 @@ _FIG_JUNK = re.compile(
     re.IGNORECASE
 )
 
+_FIGURE_RE = re.compile(r'^Figure\s*:\s*(.+)', re.I)
+
+# Figure / [DIAGRAM:] description clean-up and fuzzy key matching.
+_DIAG_PREFIX_RE = re.compile(r'^DIAGRAM:\s*', re.I)
+_ANGLE_TAIL_RE  = re.compile(r'(?:\.\s*)?(?:Angle\s+[A-Z]\s*=?\s*\d+°?\s*){1,}$')
+_ANGLE_RUN_RE   = re.compile(r'(?:\s*\d+°){2,}')
+_WORD_RE        = re.compile(r'\w+')
+
+# Characters a _HDR_SKIP / _FIG_JUNK match can start with, so most lines
+# skip both alternations on a set lookup. Both are IGNORECASE, which also
+# folds in ſ, İ, ı and the Kelvin sign; _FIG_JUNK can additionally start
+# with any \d, tested via str.isdecimal().
+_HDR_PREFIX = frozenset('SCBTDscbtd\u017f')
+_FIG_PREFIX = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                        '\u0130\u0131\u017f\u212a' 'αΑθΘϑϴ∠')
+
+# ── Line classification ───────────────────────────────────────────────
+# One pass over the stripped line decides which branch of the body loop
+# handles it. Cheap first-character tests run before any regex, and the
+# order matches the precedence the loop has always used. Header and
+# instruction lines repeat across papers, so results are memoised.
+LT_BLANK, LT_TABLE, LT_DIVIDER, LT_SKIP, LT_FIGURE, LT_HRULE, \
+    LT_DIAGRAM, LT_INSTR_HDR, LT_SECTION, LT_TEXT = range(10)
+
+@lru_cache(maxsize=1024)
+def classify_line(s):
+    if not s:
+        return LT_BLANK
+    c = s[0]
+    if c == '|':
+        return LT_DIVIDER if _DIVIDER_RE.match(s) else LT_TABLE
+    if ((c in _HDR_PREFIX and _HDR_SKIP.match(s))
+            or ((c in _FIG_PREFIX or c.isdecimal()) and _FIG_JUNK.match(s))):
+        return LT_SKIP
+    if _FIGURE_RE.match(s):
+        return LT_FIGURE
+    if c in '-=_' and _is_hrule(s):
+        return LT_HRULE
+    if c == '[' and (s.startswith('[DIAGRAM:') or s[:5].lower() == '[draw'):
+        return LT_DIAGRAM
+    if _GEN_INSTR_RE.match(s):
+        return LT_INSTR_HDR
+    if _SEC_HDR_RE.match(s) or _INSTR_HDR_RE.match(s):
+        return LT_SECTION
+    return LT_TEXT
+
 
 # ═══════════════════════════════════════════════════════════════════════
 # MAIN PDF BUILDER
@@ -548,8 +797,61 @@ def _strip_ai_noise(text: str) -> str:
     return '\n'.join(lines[start_idx:end_idx]).strip()
 
 
+def _unescape_md(raw):
+    """Undo the markdown escapes (\\- and \\_) the model puts in plain text."""
+    return raw.replace('\\-', '-').replace('\\_', '_')
+
+
+def _key_flowables(answer_key, st, pw):
+    """Yield the answer-key flowables, one source line at a time."""
+    k_sec, k_q, k_sub, k_step = st["KSec"], st["KQ"], st["KSub"], st["KStep"]
+    for raw_k in StringIO(answer_key):
+        sk = _unescape_md(raw_k.rstrip()).strip()
+
+        if not sk:
+            yield Spacer(1, 3)
+            continue
+
+        c    = sk[0]
+        km   = (_KEY_LINE_RE.match(sk)
+                if c in _KEY_LINE_PREFIX or c.isdecimal() else None)
+        kind = km.lastgroup if km else None
+
+        if kind == 'sec':
+            ks = Table([[Paragraph(f'<b>{sk.rstrip(":")}:</b>',
+                                   k_sec)]], colWidths=[pw])
+            ks.setStyle(_KEY_SEC_STYLE)
+            yield Spacer(1, 6)
+            yield ks
+            yield Spacer(1, 4)
+            continue
+
+        if kind == 'qbody':
+            body_k = km.group('qbody').strip()
+            mk_k = _MARK_TAG_RE.search(body_k)
+            mk_str = ''
+            if mk_k:
+                mk_str  = (f'  <font color="{_HEX["MARK"]}" size="9">'
+                           f'<b>{mk_k.group(1)}</b></font>')
+                body_k  = body_k[:mk_k.start()].strip()
+            body_rl = _process(body_k) if body_k else ''
+            yield Paragraph(f'<b>{km.group("qnum")}.</b>  {body_rl}{mk_str}', k_q)
+            continue
+
+        if kind == 'sbody':
+            yield Paragraph(
+                f'<b>({km.group("sl")})</b>  {_process(km.group("sbody"))}',
+                k_sub)
+            continue
+
+        # Indented working, equations, "∴ …" conclusions and plain prose
+        # all render as solution steps.
+        yield Paragraph(_process(sk), k_step)
+
+
 def create_exam_pdf(text, subject, chapter, board="",
-                   answer_key=None, include_key=False, diagrams=None) -> bytes:
+                   answer_key=None, include_key=False, diagrams=None,
+                   out=None) -> BytesIO:
 
     # Strip AI preamble/closing noise before parsing
     text = _strip_ai_noise(text)
@@ -564,7 +866,12 @@ def create_exam_pdf(text, subject, chapter, board="",
     TM = 16 * mm
     PW = A4[0] - LM - RM
 
-    buf = BytesIO()
+    if diagrams and _WKHTML_AVAILABLE:
+        _prewarm_diagrams(diagrams, PW * 0.65)
+
+    # Render into the caller's stream when given one (e.g. a spooled temp
+    # file), otherwise into a fresh in-memory buffer.
+    buf = out if out is not None else BytesIO()
     doc = SimpleDocTemplate(buf, pagesize=A4,
                             leftMargin=LM, rightMargin=RM,
                             topMargin=TM, bottomMargin=BM,
@@ -590,15 +897,7 @@ def create_exam_pdf(text, subject, chapter, board="",
     tbl_title = Table(
         [[Paragraph(title_str, st["PTitle"])]],
         colWidths=[PW])
-    tbl_title.setStyle(TableStyle([
-        ("BACKGROUND",    (0,0),(-1,-1), white),
-        ("LINEBELOW",     (0,0),(-1,-1), 1.5, black),
-        ("LINETOP",       (0,0),(-1,-1), 1.5, black),
-        ("TOPPADDING",    (0,0),(-1,-1), 6),
-        ("BOTTOMPADDING", (0,0),(-1,-1), 6),
-        ("LEFTPADDING",   (0,0),(-1,-1), 0),
-        ("RIGHTPADDING",  (0,0),(-1,-1), 0),
-    ]))
+    tbl_title.setStyle(_HEADER_TITLE_STYLE)
 
     left_meta  = "  |  ".join(x for x in [h_board, f"Class {h_class}" if h_class else ""] if x)
     right_meta = f"Total Marks: {h_marks}   |   Time: {h_time}"
@@ -606,32 +905,25 @@ def create_exam_pdf(text, subject, chapter, board="",
         [[Paragraph(left_meta,  st["PMeta"]),
           Paragraph(right_meta, st["PMetaR"])]],
         colWidths=[PW*0.55, PW*0.45])
-    tbl_meta.setStyle(TableStyle([
-        ("BACKGROUND",    (0,0),(-1,-1), white),
-        ("LINEBELOW",     (0,0),(-1,-1), 0.6, HexColor("#888888")),
-        ("TOPPADDING",    (0,0),(-1,-1), 3),
-        ("BOTTOMPADDING", (0,0),(-1,-1), 4),
-        ("LEFTPADDING",   (0,0),(-1,-1), 0),
-        ("RIGHTPADDING",  (0,0),(-1,-1), 0),
-        ("VALIGN",        (0,0),(-1,-1), "MIDDLE"),
-    ]))
+    tbl_meta.setStyle(_HEADER_META_STYLE)
 
     elems += [tbl_title, tbl_meta, Spacer(1, 8)]
 
     tbl_rows    = []
+    tbl_cols    = 0
     in_table    = False
     pending_opts = []
     in_instr    = False
 
     def flush_table():
-        nonlocal tbl_rows, in_table
+        nonlocal tbl_rows, tbl_cols, in_table
         if tbl_rows:
-            t = _pipe_table(tbl_rows, st, PW)
+            t = _pipe_table(tbl_rows, st, PW, tbl_cols)
             if t:
                 elems.append(Spacer(1, 3))
                 elems.append(t)
                 elems.append(Spacer(1, 5))
-        tbl_rows, in_table = [], False
+        tbl_rows, tbl_cols, in_table = [], 0, False
 
     def flush_opts():
         nonlocal pending_opts
@@ -640,70 +932,69 @@ def create_exam_pdf(text, subject, chapter, board="",
             elems.append(Spacer(1, 3))
         pending_opts = []
 
-    lines = text.split('\n')
-    i_line = 0
-
-    def _is_general_instr(s):
-        return bool(re.match(r'^(GENERAL INSTRUCTIONS|General Instructions'
-                             r'|Instructions)\s*$', s.strip()))
-
-    def _is_instr_line(s):
-        return bool(re.match(r'^\d+\.\s+', s.strip())) and in_instr
+    # Word sets of the diagram keys, for fuzzy [DIAGRAM:] matching —
+    # built once per document instead of once per marker.
+    diag_index = [(k, frozenset(_WORD_RE.findall(k.lower())))
+                  for k, v in diagrams.items() if v] if diagrams else []
 
-    while i_line < len(lines):
-        raw  = lines[i_line].rstrip()
-        line = re.sub(r'\\_', '_', re.sub(r'\\-', '-', raw))
+    # StringIO iterates lines in C without materialising a list of them;
+    # the trailing '\n' each line keeps is removed by rstrip().
+    for raw in StringIO(text):
+        raw  = raw.rstrip()
+        line = _unescape_md(raw)
         s    = line.strip()
-        i_line += 1
+        tag  = classify_line(s)
 
-        if _is_table_row(line):
-            if _is_divider(line):
-                continue
+        if tag == LT_DIVIDER:
+            continue
+        if tag == LT_TABLE:
             flush_opts()
-            cells = [c.strip() for c in line.split('|') if c.strip()]
-            if cells:
+            # Keep empty cells so columns stay aligned; only the edges
+            # outside the leading/trailing pipes are dropped.
+            cells = [c.strip() for c in s.split('|')[1:]]
+            if cells and not cells[-1]:
+                cells.pop()
+            if any(cells):
                 tbl_rows.append(cells)
+                tbl_cols = max(tbl_cols, len(cells))
                 in_table = True
             continue
         elif in_table:
             flush_table()
 
-        if not s:
+        if tag == LT_BLANK:
             flush_opts()
             elems.append(Spacer(1, 4))
             continue
 
-        if _HDR_SKIP.match(s):
-            continue
-
-        # Drop stray figure-description lines that the AI emits alongside [DIAGRAM:] markers
-        if _FIG_JUNK.match(s):
+        # Header lines, and stray figure-description lines that the AI
+        # emits alongside [DIAGRAM:] markers, are dropped
+        if tag == LT_SKIP:
             continue
 
         # "Figure: ..." lines emitted outside [DIAGRAM:] tags — convert to italic label
-        fig_m = re.match(r'^Figure\s*:\s*(.+)', s, re.I)
-        if fig_m:
+        if tag == LT_FIGURE:
             flush_opts()
-            desc = fig_m.group(1).strip()
+            desc = s.partition(':')[2].strip()
             # Remove trailing angle noise like "Angle A = 60° Angle B = 60°..."
-            desc = re.sub(r'(?:\.\s*)?(?:Angle\s+[A-Z]\s*=?\s*\d+°?\s*){1,}$', '', desc).strip()
-            desc = re.sub(r'(?:\s*\d+°){2,}', '', desc).strip()
+            desc = _ANGLE_TAIL_RE.sub('', desc).strip()
+            desc = _ANGLE_RUN_RE.sub('', desc).strip()
             if desc:
                 elems.append(Paragraph(f'<i>Figure: {desc}</i>', st["DiagLabel"]))
             continue
 
-        if _is_hrule(line):
+        if tag == LT_HRULE:
             flush_opts()
             elems.append(HRFlowable(width="100%", thickness=0.4,
                                     color=C_RULE, spaceBefore=3, spaceAfter=3))
             continue
 
-        if s.startswith('[DIAGRAM:') or s.lower().startswith('[draw'):
+        if tag == LT_DIAGRAM:
             flush_opts()
             label   = s.strip('[]')
-            desc    = re.sub(r'^DIAGRAM:\s*', '', label, flags=re.I).strip()
+            desc    = _DIAG_PREFIX_RE.sub('', label).strip()
             # Sanitise desc — drop any angle/measurement noise that crept in
-            desc = re.sub(r'(?:\s*\d+°){2,}', '', desc).strip()
+            desc = _ANGLE_RUN_RE.sub('', desc).strip()
             elems.append(Paragraph(f'<i>Figure: {desc}</i>', st["DiagLabel"]))
 
             drawing = None
@@ -713,12 +1004,9 @@ def create_exam_pdf(text, subject, chapter, board="",
                     drawing = svg_to_best_image(diagrams[desc], width_pt=PW * 0.65)
                 if drawing is None:
                     # Fuzzy match: find diagram key with most word overlap
-                    desc_words = set(re.findall(r'\w+', desc.lower()))
+                    desc_words = frozenset(_WORD_RE.findall(desc.lower()))
                     best_key, best_score = None, 0
-                    for d_key, d_svg in diagrams.items():
-                        if not d_svg:
-                            continue
-                        key_words = set(re.findall(r'\w+', d_key.lower()))
+                    for d_key, key_words in diag_index:
                         overlap = len(desc_words & key_words)
                         if overlap > best_score:
                             best_score, best_key = overlap, d_key
@@ -729,48 +1017,20 @@ def create_exam_pdf(text, subject, chapter, board="",
                 elems.append(Spacer(1, 3))
                 # Centre the drawing
                 outer_d = Table([[drawing]], colWidths=[PW])
-                outer_d.setStyle(TableStyle([
-                    ('ALIGN',         (0,0),(-1,-1), 'CENTER'),
-                    ('TOPPADDING',    (0,0),(-1,-1), 2),
-                    ('BOTTOMPADDING', (0,0),(-1,-1), 2),
-                ]))
+                outer_d.setStyle(_DIAGRAM_OUTER_STYLE)
                 elems.append(outer_d)
             else:
-                # Clean placeholder box — no stray text inside, just a neat space
-                blank_height_mm = 38  # ~38 mm reserved for hand-drawn diagram
-                ph_label = Paragraph(
-                    f'<i>[ Draw diagram here: {desc} ]</i>',
-                    st["DiagLabel"])
-                box = Table(
-                    [[ph_label],
-                     [Spacer(1, blank_height_mm * mm - 20)]],
-                    colWidths=[PW * 0.72])
-                box.setStyle(TableStyle([
-                    ('BOX',           (0,0),(-1,-1), 0.6, C_RULE),
-                    ('BACKGROUND',    (0,0),(-1,-1), HexColor('#f9f9f9')),
-                    ('TOPPADDING',    (0,0),(-1,-1), 6),
-                    ('BOTTOMPADDING', (0,0),(-1,-1), 6),
-                    ('LEFTPADDING',   (0,0),(-1,-1), 10),
-                    ('RIGHTPADDING',  (0,0),(-1,-1), 10),
-                    ('VALIGN',        (0,0),(-1,-1), 'TOP'),
-                ]))
-                outer = Table([[box]], colWidths=[PW])
-                outer.setStyle(TableStyle([
-                    ('ALIGN',         (0,0),(-1,-1), 'CENTER'),
-                    ('TOPPADDING',    (0,0),(-1,-1), 2),
-                    ('BOTTOMPADDING', (0,0),(-1,-1), 4),
-                ]))
-                elems.append(outer)
+                elems.append(_placeholder(desc, st, PW))
             elems.append(Spacer(1, 5))
             continue
 
-        if _is_general_instr(s):
+        if tag == LT_INSTR_HDR:
             flush_opts()
             in_instr = True
             # Skip instructions header — don't render to save space
             continue
 
-        if _is_sec_hdr(line) and not _is_general_instr(s):
+        if tag == LT_SECTION:
             flush_opts()
             in_instr = False
             elems.append(Spacer(1, 4))
@@ -778,12 +1038,12 @@ def create_exam_pdf(text, subject, chapter, board="",
             elems.append(Spacer(1, 3))
             continue
 
-        if _is_instr_line(s):
+        if in_instr and _NUM_ITEM_RE.match(s):
             # Skip instructions to save paper space
             continue
 
-        opt_m = re.match(r'^\s*[\(\[]\s*([a-dA-D])\s*[\)\]\.]?\s+(.+)', s)
-        if opt_m and not re.match(r'^(Q\.?\s*)?\d+[\.)\]]\s', s):
+        opt_m = _OPT_RE.match(s)
+        if opt_m and not _QNUM_RE.match(s):
             in_instr = False
             letter = opt_m.group(1).lower()
             val    = _process(opt_m.group(2))
@@ -792,45 +1052,48 @@ def create_exam_pdf(text, subject, chapter, board="",
                 flush_opts()
             continue
 
-        multi = re.findall(
-            r'[\(\[]([a-dA-D])[\)\]\.]?\s+([^(\[]+?)(?=\s*[\(\[][a-dA-D][\)\]\.]|$)',
-            s)
-        if len(multi) >= 2 and not re.match(r'^(Q\.?\s*)?\d+[\.)\]]\s', s):
-            flush_opts()
-            in_instr = False
-            opts = [(l.lower(), _process(v.strip())) for l, v in multi]
-            elems.append(_opts_table(opts, st, PW))
-            elems.append(Spacer(1, 3))
-            continue
+        # Inline options "(a) .. (b) ..": stop scanning as soon as it's
+        # clear there aren't two, and skip lines with no bracket at all.
+        if '(' in s or '[' in s:
+            it = _MULTI_OPT_RE.finditer(s)
+            first, second = next(it, None), next(it, None)
+            if second is not None and not _QNUM_RE.match(s):
+                flush_opts()
+                in_instr = False
+                opts = [(m.group(1).lower(), _process(m.group(2).strip()))
+                        for m in (first, second, *it)]
+                elems.append(_opts_table(opts, st, PW))
+                elems.append(Spacer(1, 3))
+                continue
 
-        q_m = re.match(r'^(Q\.?\s*)?(\d+)[\.)\]]\s+(.+)', s)
+        q_m = _QLINE_RE.match(s)
         if q_m and not in_instr:
             flush_opts()
             in_instr = False
             qnum  = q_m.group(2)
             qbody = q_m.group(3)
-            mk_m = re.search(r'\[\s*(\d+)\s*[Mm]arks?\s*\]\s*$', qbody)
+            mk_m = _MARK_TAG_RE.search(qbody)
             mark_tag = ''
             if mk_m:
-                mark_tag = f'[{mk_m.group(1)}M]'
+                mark_tag = f'[{mk_m.group(2)}M]'
                 qbody    = qbody[:mk_m.start()].strip()
             body_rl = _process(qbody)
-            mark_rl = (f'  <font color="{C_GREY.hexval()}" size="9">'
+            mark_rl = (f'  <font color="{_HEX["GREY"]}" size="9">'
                        f'{mark_tag}</font>') if mark_tag else ''
-            xml = (f'<font color="{C_STEEL.hexval()}"><b>{qnum}.</b></font>'
+            xml = (f'<font color="{_HEX["STEEL"]}"><b>{qnum}.</b></font>'
                    f'  {body_rl}{mark_rl}')
             elems.append(Paragraph(xml, st["Q"]))
             continue
 
-        sub_m = re.match(r'^\s*[\(\[]\s*([a-z])\s*[\)\]]\s+(.+)', s)
+        sub_m = _SUB_RE.match(s)
         if sub_m and not in_instr:
             flush_opts()
             sl    = sub_m.group(1)
             sbod  = sub_m.group(2)
-            mk_m2 = re.search(r'(\[\s*\d+\s*[Mm]arks?\s*\])\s*$', sbod)
+            mk_m2 = _MARK_TAG_RE.search(sbod)
             mark2 = ''
             if mk_m2:
-                mark2 = (f'  <font color="{C_MARK.hexval()}" size="9.5">'
+                mark2 = (f'  <font color="{_HEX["MARK"]}" size="9.5">'
                          f'<b>{mk_m2.group(1)}</b></font>')
                 sbod  = sbod[:mk_m2.start()].strip()
             elems.append(Paragraph(
@@ -849,95 +1112,43 @@ def create_exam_pdf(text, subject, chapter, board="",
     if include_key and answer_key and answer_key.strip():
         elems.append(PageBreak())
         kt = Table([[Paragraph("ANSWER KEY", st["KTitle"])]], colWidths=[PW])
-        kt.setStyle(TableStyle([
-            ("BACKGROUND",    (0,0),(-1,-1), C_KFILL),
-            ("LINEBELOW",     (0,0),(-1,-1), 2.0, black),
-            ("LINETOP",       (0,0),(-1,-1), 2.0, black),
-            ("TOPPADDING",    (0,0),(-1,-1), 8),
-            ("BOTTOMPADDING", (0,0),(-1,-1), 8),
-        ]))
+        kt.setStyle(_KEY_TITLE_STYLE)
         elems += [kt, Spacer(1, 10)]
 
-        key_lines = answer_key.split('\n')
-        ki = 0
-        while ki < len(key_lines):
-            raw_k  = key_lines[ki].rstrip()
-            line_k = re.sub(r'\\_', '_', re.sub(r'\\-', '-', raw_k))
-            sk     = line_k.strip()
-            ki    += 1
-
-            if not sk:
-                elems.append(Spacer(1, 3))
-                continue
-
-            if re.match(r'^(Section|SECTION|Part|PART)\s+[A-Da-d]\b', sk):
-                ks = Table([[Paragraph(f'<b>{sk.rstrip(":")}:</b>',
-                                       st["KSec"])]], colWidths=[PW])
-                ks.setStyle(TableStyle([
-                    ("BACKGROUND",    (0,0),(-1,-1), HexColor("#f0f0f0")),
-                    ("LINEBELOW",     (0,0),(-1,-1), 0.8, HexColor("#111111")),
-                    ("LEFTPADDING",   (0,0),(-1,-1), 10),
-                    ("TOPPADDING",    (0,0),(-1,-1), 4),
-                    ("BOTTOMPADDING", (0,0),(-1,-1), 4),
-                ]))
-                elems += [Spacer(1, 6), ks, Spacer(1, 4)]
-                continue
-
-            q_km = re.match(r'^(Q\.?\s*)?(\d+)[\.)\]]\s*(.*)', sk)
-            if q_km:
-                body_k = q_km.group(3).strip()
-                mk_k = re.search(r'(\[\s*\d+\s*[Mm]arks?\s*\])\s*$', body_k)
-                mk_str = ''
-                if mk_k:
-                    mk_str  = (f'  <font color="{C_MARK.hexval()}" size="9">'
-                               f'<b>{mk_k.group(1)}</b></font>')
-                    body_k  = body_k[:mk_k.start()].strip()
-                body_rl = _process(body_k) if body_k else ''
-                elems.append(Paragraph(
-                    f'<b>{q_km.group(2)}.</b>  {body_rl}{mk_str}',
-                    st["KQ"]))
-                continue
-
-            sub_km = re.match(r'^\(?([a-z])\)\.?\s+(.+)', sk)
-            if sub_km:
-                elems.append(Paragraph(
-                    f'<b>({sub_km.group(1)})</b>  {_process(sub_km.group(2))}',
-                    st["KSub"]))
-                continue
-
-            if raw_k.startswith('   ') or raw_k.startswith('\t'):
-                elems.append(Paragraph(_process(sk), st["KStep"]))
-                continue
-
-            if (sk.startswith('$') or
-                    re.match(r'^[A-Za-z]\s*[=<>≤≥]', sk) or
-                    re.match(r'^\s*(∴|Therefore|Hence|Thus)\b', sk, re.I)):
-                elems.append(Paragraph(_process(sk), st["KStep"]))
-                continue
-
-            elems.append(Paragraph(_process(sk), st["KStep"]))
+        elems.extend(_key_flowables(answer_key, st, PW))
 
     doc.build(elems, onFirstPage=ExamCanvas(), onLaterPages=ExamCanvas())
-    pdf = buf.getvalue()
-    buf.close()
-    return pdf
+    # Hand the buffer back rewound rather than copying it out with
+    # getvalue() — send_file reads it directly.
+    buf.seek(0)
+    return buf
 
 
 # ═══════════════════════════════════════════════════════════════════════
 # GEMINI
 # ═══════════════════════════════════════════════════════════════════════
 _discovered_models = []
+_genai_configured  = False
+
+def _ensure_configured():
+    """The SDK with the API key set — configure() runs once per process."""
+    global _genai_configured
+    sdk = _ensure_genai()
+    if not _genai_configured:
+        sdk.configure(api_key=GEMINI_KEY)
+        _genai_configured = True
+    return sdk
 
 def discover_models():
     global _discovered_models
     if _discovered_models:
         return _discovered_models
-    if not (GEMINI_KEY and GENAI_AVAILABLE):
+    if not _GEMINI_READY:
         return []
     try:
-        genai.configure(api_key=GEMINI_KEY)
+        sdk = _ensure_configured()
         models = []
-        for m in genai.list_models():
+        for m in sdk.list_models():
             if "generateContent" in (m.supported_generation_methods or []):
                 models.append(m.name.replace("models/", ""))
         preferred = ["gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-pro", "gemini-2.0-flash-exp"]
@@ -949,38 +1160,281 @@ def discover_models():
         return ["gemini-2.0-flash", "gemini-1.5-flash", "gemini-pro", "gemini-2.0-flash-exp"]
 
 
-def call_gemini(prompt):
-    if not (GEMINI_KEY and GENAI_AVAILABLE):
-        return None, "Gemini not configured."
-    models_to_try = discover_models()
-    if not models_to_try:
-        return None, "No Gemini models discovered."
+# ── Quota circuit breaker ─────────────────────────────────────────────
+# When every model is answering 429/quota, walking the whole list per
+# request only adds latency. After enough quota errors in a short window
+# the breaker opens and callers skip Gemini until the cooldown passes.
+_BREAKER = {"fail_count": 0, "first_fail": 0.0, "open_until": 0.0}
+_BREAKER_THRESHOLD = 5       # quota errors ...
+_BREAKER_WINDOW    = 60.0    # ... within this many seconds trip it
+_BREAKER_COOLDOWN  = 120.0   # seconds to stay open
+_BREAKER_OPEN_MSG  = "circuit_open"
+
+def _breaker_open():
+    return time.time() < _BREAKER["open_until"]
+
+def _breaker_record_quota_error():
+    now = time.time()
+    if now - _BREAKER["first_fail"] > _BREAKER_WINDOW:
+        _BREAKER["fail_count"], _BREAKER["first_fail"] = 0, now
+    _BREAKER["fail_count"] += 1
+    if _BREAKER["fail_count"] >= _BREAKER_THRESHOLD:
+        _BREAKER["open_until"] = now + _BREAKER_COOLDOWN
+        _BREAKER["fail_count"] = 0
+
+
+# Local rate gate: at most _GEMINI_CONCURRENCY calls in flight per process,
+# and no model is sent more than _GEMINI_RPM requests in any 60s window.
+# Shedding load here is cheaper than spending quota on guaranteed 429s.
+_GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "4"))
+_GEMINI_RPM         = int(os.environ.get("GEMINI_RPM", "10"))
+_GEMINI_SEM         = threading.BoundedSemaphore(_GEMINI_CONCURRENCY)
+_GEMINI_SEM_WAIT    = 10.0
+_RATE_LIMITED_MSG   = "rate_limited_locally"
+_MODEL_CALLS        = defaultdict(deque)
+_MODEL_CALLS_LOCK   = threading.Lock()
+
+# api_error values that mean "serve the template paper" rather than a 502.
+_FALLBACK_ERRORS = (_BREAKER_OPEN_MSG, _RATE_LIMITED_MSG)
+
+def _rpm_take(model_name):
+    """Reserve a request slot for model_name; False if its window is full."""
+    now = time.monotonic()
+    with _MODEL_CALLS_LOCK:
+        calls = _MODEL_CALLS[model_name]
+        while calls and now - calls[0] > 60.0:
+            calls.popleft()
+        if len(calls) >= _GEMINI_RPM:
+            return False
+        calls.append(now)
+        return True
+
+
+_GEN_CONFIG = {"temperature": 0.3, "max_output_tokens": 8192, "top_p": 0.8}
+
+# Upper bound on a single Gemini HTTP call, so a stalled request can't pin
+# a worker thread indefinitely.
+_REQUEST_OPTIONS = {"timeout": float(os.environ.get("GEMINI_TIMEOUT", "60"))}
+
+# Default model for paper generation. Flash answers several times faster
+# than Pro and is good enough for question papers; clients can still ask
+# for Pro with quality="high".
+_GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash").strip()
+
+def _models_for(quality=None):
+    """Discovered models in the order to try them for this request."""
+    models = discover_models()
+    if quality == "high":
+        lead = [n for n in models if "pro" in n]
+    else:
+        lead = [n for n in models if n == _GEMINI_MODEL]
+    return lead + [n for n in models if n not in lead] if lead else models
+
+# Model objects are built once per discovered name and reused across
+# requests and retries (the model list isn't known until discovery runs).
+_MODEL_POOL = {}
+
+def _get_model(model_name):
+    model = _MODEL_POOL.get(model_name)
+    if model is None:
+        model = _MODEL_POOL.setdefault(
+            model_name, _ensure_configured().GenerativeModel(model_name, generation_config=_GEN_CONFIG))
+    return model
+
+
+# Hedged requests: the second-choice model is started if the first fails,
+# or hasn't answered within this many seconds, and whichever returns text
+# first wins. Keep it above typical generation latency — every hedge that
+# fires doubles the quota spent on that request.
+_HEDGE_DELAY  = float(os.environ.get("GEMINI_HEDGE_DELAY", "8.0"))
+_GEMINI_POOL  = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini")
+
+
+# The only sleep left in the retry path is the retry_delay Gemini sends
+# with a 429, and it is never allowed past this many seconds per call.
+_RETRY_BUDGET   = 20.0
+_RETRY_DELAY_RE = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)')
+_TRANSIENT_RE   = re.compile(
+    r'connect|reset by peer|timed? ?out|deadline|unavailable|\b50[0234]\b', re.I)
+
+
+def _wait_retry_delay(err, deadline):
+    """Sleep for the server's retry_delay (plus jitter); False if there is
+    none or the remaining budget can't cover it."""
+    m = _RETRY_DELAY_RE.search(err)
+    if not m:
+        return False
+    delay = int(m.group(1)) + random.random()
+    if time.monotonic() + delay > deadline:
+        return False
+    time.sleep(delay)
+    return True
+
+
+def _try_model(model_name, prompt, deadline, last=False):
+    """Run one model with the retry policy. Returns (text, error).
+    A 429 moves on to the next model, except on the last one, where the
+    server's retry_delay is honoured if it fits the budget."""
     last_error = ""
-    for model_name in models_to_try:
-        for attempt in range(2):
-            try:
-                model = genai.GenerativeModel(
-                    model_name,
-                    generation_config={"temperature": 0.3, "max_output_tokens": 8192, "top_p": 0.8})
-                response = model.generate_content(prompt)
-                if response and hasattr(response, "text") and response.text.strip():
-                    return response.text.strip(), None
-                last_error = f"{model_name}: empty response"
+    for attempt in range(2):
+        if not _rpm_take(model_name):
+            return None, last_error or _RATE_LIMITED_MSG
+        try:
+            model = _get_model(model_name)
+            response = model.generate_content(prompt, request_options=_REQUEST_OPTIONS)
+            if response and hasattr(response, "text") and response.text.strip():
+                _BREAKER["fail_count"] = 0
+                return response.text.strip(), None
+            return None, f"{model_name}: empty response"
+        except Exception as e:
+            err = str(e)
+            last_error = f"{model_name} ({attempt+1}): {err}"
+            if "429" in err or "quota" in err.lower():
+                _breaker_record_quota_error()
+                if last and attempt == 0 and _wait_retry_delay(err, deadline):
+                    continue
                 break
-            except Exception as e:
-                err = str(e)
-                last_error = f"{model_name} ({attempt+1}): {err}"
-                if "429" in err or "404" in err or "quota" in err.lower():
-                    time.sleep(0.3); break
-                if attempt == 0:
-                    time.sleep(1.5); continue
+            if "404" in err:
                 break
+            # Dropped connections and timeouts are worth one immediate
+            # retry; anything else moves on to the next model.
+            if attempt == 0 and _TRANSIENT_RE.search(err) and time.monotonic() < deadline:
+                continue
+            break
     return None, last_error
 
 
+def call_gemini(prompt, quality=None):
+    """Returns (text, error, model) — model is the one that answered."""
+    if not _GEMINI_READY:
+        return None, "Gemini not configured.", None
+    if _breaker_open():
+        return None, _BREAKER_OPEN_MSG, None
+    if not _GEMINI_SEM.acquire(timeout=_GEMINI_SEM_WAIT):
+        return None, _RATE_LIMITED_MSG, None
+    inflight = []
+    try:
+        return _call_models(prompt, _models_for(quality), inflight)
+    finally:
+        _release_after(inflight)
+
+
+def _release_after(futures):
+    """Give back the caller's _GEMINI_SEM slot once no request it started
+    is still running. A losing hedge can't be cancelled mid-call, so it
+    keeps the slot until it returns."""
+    live = [f for f in futures if not f.done()]
+    if not live:
+        _GEMINI_SEM.release()
+        return
+    left = [len(live)]
+    lock = threading.Lock()
+    def _done(_f):
+        with lock:
+            left[0] -= 1
+            if left[0]:
+                return
+        _GEMINI_SEM.release()
+    for f in live:
+        f.add_done_callback(_done)
+
+
+def _call_models(prompt, models_to_try, inflight=None):
+    """inflight, if given, collects the futures started here so the caller
+    can tell when they have all finished."""
+    if not models_to_try:
+        return None, "No Gemini models discovered.", None
+    last_error = ""
+    deadline   = time.monotonic() + _RETRY_BUDGET
+    final      = models_to_try[-1]
+
+    # The leader gets _HEDGE_DELAY to answer; after that (or as soon as it
+    # fails) the second model joins and the first text back wins.
+    leaders = models_to_try[:2]
+    pending = [_GEMINI_POOL.submit(_try_model, leaders[0], prompt,
+                                   deadline, leaders[0] == final)]
+    if inflight is not None:
+        inflight.extend(pending)
+    if len(models_to_try) > 1:
+        wait(pending, timeout=_HEDGE_DELAY)
+        if not (pending[0].done() and pending[0].result()[0]):
+            pending.append(_GEMINI_POOL.submit(_try_model, leaders[1], prompt,
+                                               deadline, leaders[1] == final))
+            if inflight is not None:
+                inflight.append(pending[-1])
+    for fut in as_completed(pending):
+        text, err = fut.result()
+        if text:
+            for other in pending:
+                other.cancel()
+            return text, None, leaders[pending.index(fut)]
+        last_error = err or last_error
+
+    for model_name in models_to_try[2:]:
+        if time.monotonic() >= deadline:
+            break
+        text, err = _try_model(model_name, prompt, deadline, model_name == final)
+        if text:
+            return text, None, model_name
+        last_error = err or last_error
+    return None, last_error, None
+
+
+def stream_gemini(prompt, quality=None, info=None):
+    """
+    Yield response text chunks as Gemini produces them.
+    Models are tried in _models_for() order until one starts answering; once
+    a chunk has been yielded the stream is committed to that model, and its
+    name is stored in info["model"]. Raises RuntimeError with the last error
+    if no model produced any text.
+    """
+    if not _GEMINI_READY:
+        raise RuntimeError("Gemini not configured.")
+    if _breaker_open():
+        raise RuntimeError(_BREAKER_OPEN_MSG)
+    if not _GEMINI_SEM.acquire(timeout=_GEMINI_SEM_WAIT):
+        raise RuntimeError(_RATE_LIMITED_MSG)
+    try:
+        yield from _stream_models(prompt, _models_for(quality), info)
+    finally:
+        _GEMINI_SEM.release()
+
+
+def _stream_models(prompt, models, info=None):
+    last_error = "No Gemini models discovered."
+    for model_name in models:
+        if not _rpm_take(model_name):
+            last_error = _RATE_LIMITED_MSG
+            continue
+        started = False
+        try:
+            model = _get_model(model_name)
+            for chunk in model.generate_content(prompt, stream=True,
+                                              request_options=_REQUEST_OPTIONS):
+                text = chunk.text
+                if text:
+                    if not started and info is not None:
+                        info["model"] = model_name
+                    started = True
+                    yield text
+            if started:
+                _BREAKER["fail_count"] = 0
+                return
+            last_error = f"{model_name}: empty response"
+        except Exception as e:
+            if started:
+                raise RuntimeError(f"{model_name}: stream interrupted: {e}")
+            err = str(e)
+            last_error = f"{model_name}: {err}"
+            if "429" in err or "quota" in err.lower():
+                _breaker_record_quota_error()
+    raise RuntimeError(last_error)
+
+
 # ═══════════════════════════════════════════════════════════════════════
 # FALLBACK PAPER (used when Gemini is unavailable)
 # ═══════════════════════════════════════════════════════════════════════
+@lru_cache(maxsize=256)
 def build_local_paper(cls, subject, chapter, marks, difficulty):
     return f"""{subject or "Science"} — Model Question Paper
 Subject: {subject or "Science"}   Class: {cls}
@@ -1080,23 +1534,24 @@ Section-VII:
 # MATH NOTATION RULES (injected into every STEM prompt)
 # ═══════════════════════════════════════════════════════════════════════
 
-def _math_rules():
-    return (
-        "\nMATH NOTATION — every mathematical expression MUST be in $...$:\n"
-        "  Powers     : $x^{2}$  $a^{3}$  $10^{-3}$    ← never x2\n"
-        "  Subscripts : $H_{2}O$  $v_{0}$  $CO_{2}$     ← never H2O\n"
-        "  Fractions  : $\\frac{a}{b}$  $\\frac{mv^{2}}{r}$\n"
-        "  Roots      : $\\sqrt{2}$  $\\sqrt{b^{2}-4ac}$\n"
-        "  Greek      : $\\theta$  $\\alpha$  $\\pi$  $\\lambda$  $\\omega$\n"
-        "  Trig       : $\\sin\\theta$  $\\cos 60^{\\circ}$  $\\tan\\alpha$\n"
-        "  Units      : write cm, kg, m/s, N, Ω as plain text outside $\n"
-        "  Blanks     : use __________ (underscores, NOT LaTeX)\n"
-    )
+_MATH_RULES = (
+    "\nMATH NOTATION — every mathematical expression MUST be in $...$:\n"
+    "  Powers     : $x^{2}$  $a^{3}$  $10^{-3}$    ← never x2\n"
+    "  Subscripts : $H_{2}O$  $v_{0}$  $CO_{2}$     ← never H2O\n"
+    "  Fractions  : $\\frac{a}{b}$  $\\frac{mv^{2}}{r}$\n"
+    "  Roots      : $\\sqrt{2}$  $\\sqrt{b^{2}-4ac}$\n"
+    "  Greek      : $\\theta$  $\\alpha$  $\\pi$  $\\lambda$  $\\omega$\n"
+    "  Trig       : $\\sin\\theta$  $\\cos 60^{\\circ}$  $\\tan\\alpha$\n"
+    "  Units      : write cm, kg, m/s, N, Ω as plain text outside $\n"
+    "  Blanks     : use __________ (underscores, NOT LaTeX)\n"
+)
 
 
 # ─── helpers ──────────────────────────────────────────────────────────
+_CLASS_NUM_RE = re.compile(r'\d+')
+
 def _class_int(cls_str):
-    m = re.search(r'\d+', str(cls_str or "10"))
+    m = _CLASS_NUM_RE.search(str(cls_str or "10"))
     return int(m.group()) if m else 10
 
 
@@ -1109,6 +1564,19 @@ def _class_int(cls_str):
 # The LLM generates from its own knowledge; we just tell it the rules.
 # ═══════════════════════════════════════════════════════════════════════
 
+# Subject words that get the math-notation rules appended to the prompt.
+# Matched anywhere in the lower-cased subject, so "Mathematical Sciences"
+# or "Sciences" qualify too.
+_STEM_SUBJECTS = ("math", "science", "physics", "chemistry", "biology",
+                  "algebra", "geometry", "trigonometry", "statistics")
+_STEM_RE = re.compile("|".join(_STEM_SUBJECTS))
+
+# Board substring → competitive exam name.
+_COMP_EXAMS = (("ntse", "NTSE"), ("nso", "NSO"), ("imo", "IMO"), ("ijso", "IJSO"))
+
+# Prompts are a pure function of the form fields (all strings), so a
+# resubmitted or retried form reuses the assembled text.
+@lru_cache(maxsize=256)
 def build_prompt(class_name, subject, chapter, board, exam_type,
                  difficulty, marks, suggestions):
 
@@ -1118,20 +1586,15 @@ def build_prompt(class_name, subject, chapter, board, exam_type,
     extra = f"\nTEACHER NOTES: {suggestions.strip()}\n" if (suggestions or "").strip() else ""
 
     board_l = (board or "").lower()
-    subj_l  = (subject or "").lower()
 
-    is_stem = any(k in subj_l for k in [
-        "math", "maths", "science", "physics", "chemistry",
-        "biology", "algebra", "geometry", "trigonometry", "statistics"
-    ])
-    math_note = _math_rules() if is_stem else ""
+    is_stem = _STEM_RE.search((subject or "").lower()) is not None
+    math_note = _MATH_RULES if is_stem else ""
 
-    cls_n = int(re.search(r'\d+', cls).group()) if re.search(r'\d+', cls) else 10
+    cls_n = _class_int(cls)
 
     # --- Competitive exam ---
-    comp_map = {"ntse": "NTSE", "nso": "NSO", "imo": "IMO", "ijso": "IJSO"}
-    for key, val in comp_map.items():
-        if key in board_l or key == (board or "").lower():
+    for key, val in _COMP_EXAMS:
+        if key in board_l:
             return _prompt_competitive(val, subject, chapter, cls, m, difficulty, extra, math_note)
 
     # --- State board: route to full high-quality prompt builders ---
@@ -2569,10 +3032,25 @@ Subject: {subject}   Class: {cls_str}   Topic: {topic}   Marks: {n_q}
 
 # SPLIT PAPER / KEY
 # ═══════════════════════════════════════════════════════════════════════
+# Markers in priority order: the exact line the prompts ask for, then
+# "--- ANSWER KEY ---", then "Answer Key:" in any case. Each is tried
+# over the whole text before the next, so a stricter marker further down
+# beats a looser one above it.
+_KEY_MARKER   = "\nANSWER KEY\n"
+_KEY_DASH_RE  = re.compile(r'\n---\s*ANSWER KEY\s*---\n')
+_KEY_LOOSE_RE = re.compile(r'\nANSWER KEY:?\s*\n', re.I)
+
 def split_key(text):
-    for pat in [r'\nANSWER KEY\n', r'\n---\s*ANSWER KEY\s*---\n',
-                r'(?i)\nANSWER KEY:?\s*\n']:
-        parts = re.split(pat, text, maxsplit=1)
+    # The exact marker the prompts ask for wins over looser variants.
+    i = text.find(_KEY_MARKER)
+    if i >= 0:
+        return text[:i].strip(), text[i + len(_KEY_MARKER):].strip()
+    # Every other marker contains "answer key"; papers generated without a
+    # key skip both regex scans.
+    if "answer key" not in text.lower():
+        return text.strip(), ""
+    for pat in (_KEY_DASH_RE, _KEY_LOOSE_RE):
+        parts = pat.split(text, maxsplit=1)
         if len(parts) == 2:
             return parts[0].strip(), parts[1].strip()
     return text.strip(), ""
@@ -2654,17 +3132,124 @@ def _get_diag_context(desc: str) -> str:
 
 
 # ── Master SVG generation prompt ──────────────────────────────────────
+# ── Diagram SVG cache ─────────────────────────────────────────────────
+# The same figure descriptions recur across papers, and each miss costs a
+# Gemini call. SVGs are kept in a small in-memory LRU backed by files on
+# disk, shared between workers and kept across restarts. The disk copy
+# expires after _SVG_DISK_TTL, and the oldest files are dropped past
+# _SVG_DISK_MAX. Without DIAGRAM_CACHE_DIR the directory is a stable
+# per-user one under the temp dir, created on the first write and only
+# used while it is a real directory owned by us with mode 0700.
+_SVG_CACHE_DIR  = Path(os.environ.get("DIAGRAM_CACHE_DIR")
+                       or os.path.join(tempfile.gettempdir(),
+                                       f"qpg-diagrams-{getattr(os, 'getuid', lambda: 'user')()}"))
+_SVG_DIR_CHECK  = not os.environ.get("DIAGRAM_CACHE_DIR") and hasattr(os, "getuid")
+_svg_dir_ok     = False
+_SVG_DISK_TTL   = float(os.environ.get("DIAGRAM_CACHE_TTL", str(7 * 86400)))
+_SVG_DISK_MAX   = 2000
+_SVG_MEM        = OrderedDict()
+_SVG_MEM_MAX    = 256
+_SVG_MEM_LOCK   = threading.Lock()
+
+def _svg_cache_key(description):
+    # _SVG_PROMPT_VERSION (rules + model) is part of the key, so editing
+    # the prompt or switching models doesn't keep serving old drawings.
+    h = hashlib.blake2b(description.encode("utf-8"), digest_size=16)
+    h.update(_SVG_PROMPT_VERSION)
+    return h.hexdigest()
+
+def _svg_mem_put(key, svg):
+    with _SVG_MEM_LOCK:
+        _SVG_MEM[key] = svg
+        _SVG_MEM.move_to_end(key)
+        while len(_SVG_MEM) > _SVG_MEM_MAX:
+            _SVG_MEM.popitem(last=False)
+
+def _svg_disk_dir(create=False):
+    """The disk-cache directory, or None while it is missing (and create is
+    False) or fails the ownership check."""
+    global _svg_dir_ok
+    if _svg_dir_ok:
+        return _SVG_CACHE_DIR
+    try:
+        if create:
+            _SVG_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = os.lstat(_SVG_CACHE_DIR)
+    except OSError:
+        return None
+    if _SVG_DIR_CHECK and not (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+                               and not st.st_mode & 0o077):
+        return None
+    _svg_dir_ok = True
+    return _SVG_CACHE_DIR
+
+def _svg_cache_get(key):
+    with _SVG_MEM_LOCK:
+        svg = _SVG_MEM.get(key)
+        if svg is not None:
+            _SVG_MEM.move_to_end(key)
+            return svg
+    cache_dir = _svg_disk_dir()
+    if cache_dir is None:
+        return None
+    path = cache_dir / f"{key}.svg"
+    try:
+        if time.time() - path.stat().st_mtime > _SVG_DISK_TTL:
+            path.unlink()
+            return None
+        svg = path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+    _svg_mem_put(key, svg)
+    return svg
+
+def _svg_disk_prune(cache_dir):
+    """Drop the oldest cached files once the directory is over _SVG_DISK_MAX."""
+    try:
+        files = list(cache_dir.glob("*.svg"))
+        if len(files) <= _SVG_DISK_MAX:
+            return
+        files.sort(key=lambda p: p.stat().st_mtime)
+        for p in files[:len(files) - _SVG_DISK_MAX]:
+            p.unlink()
+    except OSError:
+        pass
+
+def _svg_cache_put(key, svg):
+    _svg_mem_put(key, svg)
+    cache_dir = _svg_disk_dir(create=True)
+    if cache_dir is None:
+        return
+    try:
+        # Write-then-rename so a concurrent reader never sees half a file.
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(svg)
+        os.replace(tmp, cache_dir / f"{key}.svg")
+    except OSError:
+        return
+    # Puts follow a Gemini call, so a directory scan here is cheap by comparison.
+    _svg_disk_prune(cache_dir)
+
+
 def generate_diagram_svg(description: str) -> str | None:
     """
     Ask Gemini to produce a clean, accurate SVG for the given description.
-    Returns the SVG string or None on failure.
+    Returns the SVG string or None on failure. Results are cached.
     """
-    ctx = _get_diag_context(description)
+    key = _svg_cache_key(description)
+    svg = _svg_cache_get(key)
+    if svg is None:
+        svg = _render_diagram_svg(description)
+        if svg:
+            _svg_cache_put(key, svg)
+    return svg
 
-    prompt = f"""You are a professional technical illustrator producing diagrams for a Class 10 Indian school exam paper.
 
-DIAGRAM TO DRAW: "{description}"
-DIAGRAM TYPE: {ctx}
+# Everything except the description is identical for every diagram, so
+# it leads the prompt: Gemini's implicit prefix cache can then reuse it
+# instead of re-reading the full rule list on every call.
+_DIAGRAM_RULES = """You are a professional technical illustrator producing diagrams for a Class 10 Indian school exam paper.
 
 ═══════════════════════════════════════════════════
 OUTPUT RULES — follow every rule or the diagram is rejected
@@ -2710,10 +3295,21 @@ COMPLETENESS:
 26. The diagram must be COMPLETE and SELF-CONTAINED — a student can understand it without reading anything else
 27. Include all parts mentioned in the description. Do not omit any component.
 28. If the description mentions specific measurements (e.g. radius 5 cm), label those measurements on the diagram
+"""
+_SVG_PROMPT_VERSION = hashlib.blake2b(
+    (_DIAGRAM_RULES + "|" + _GEMINI_MODEL).encode("utf-8"), digest_size=8).digest()
+
+
+def _render_diagram_svg(description):
+    ctx = _get_diag_context(description)
+
+    prompt = f"""{_DIAGRAM_RULES}
+DIAGRAM TO DRAW: "{description}"
+DIAGRAM TYPE: {ctx}
 
 Generate the SVG now:"""
 
-    text, _ = call_gemini(prompt)
+    text, _, _ = call_gemini(prompt)
     if not text:
         return None
 
@@ -2763,12 +3359,8 @@ def svg_to_png_bytes(svg_str: str, target_width_px: int = 900) -> bytes | None:
 </style>
 </head><body>{svg_str}</body></html>"""
 
-        with tempfile.NamedTemporaryFile(suffix='.html', delete=False, mode='w', encoding='utf-8') as f:
-            f.write(html)
-            htmlfile = f.name
-
-        pngfile = htmlfile.replace('.html', '.png')
-
+        # Pipe the page in on stdin and read the PNG back from stdout
+        # ("-" for both), so no temp files are created or cleaned up.
         result = subprocess.run([
             'wkhtmltoimage',
             '--format', 'png',
@@ -2776,21 +3368,14 @@ def svg_to_png_bytes(svg_str: str, target_width_px: int = 900) -> bytes | None:
             '--height', str(target_height_px),
             '--disable-smart-width',
             '--quality', '100',
+            '--disable-local-file-access',
             '--quiet',
-            htmlfile, pngfile
-        ], capture_output=True, timeout=20)
-
-        if result.returncode == 0 and os.path.exists(pngfile):
-            with open(pngfile, 'rb') as f:
-                png_bytes = f.read()
-            os.unlink(pngfile)
-            os.unlink(htmlfile)
-            return png_bytes if len(png_bytes) > 500 else None
-
-        # Cleanup on failure
-        for fp in [htmlfile, pngfile]:
-            if os.path.exists(fp):
-                os.unlink(fp)
+            '-', '-'
+        ], input=html.encode('utf-8'), capture_output=True, timeout=20)
+
+        png_bytes = result.stdout
+        if result.returncode == 0 and len(png_bytes) > 500:
+            return png_bytes
         return None
 
     except Exception:
@@ -2798,14 +3383,20 @@ def svg_to_png_bytes(svg_str: str, target_width_px: int = 900) -> bytes | None:
 
 
 # ── PNG bytes → ReportLab ImageFlowable ──────────────────────────────
+_PNG_SIG = b"\x89PNG\r\n\x1a\n"
+
 def png_to_rl_image(png_bytes: bytes, width_pt: float):
     """Convert PNG bytes to a ReportLab flowable Image at the given width with correct height."""
     from reportlab.platypus import Image as RLImage
-    from PIL import Image as PILImage
 
-    # Get actual PNG dimensions so we can calculate the correct height
-    pil_img = PILImage.open(BytesIO(png_bytes))
-    px_w, px_h = pil_img.size
+    # Get actual PNG dimensions so we can calculate the correct height.
+    # They sit at fixed offsets in the IHDR chunk; PIL is only needed if
+    # the bytes aren't a well-formed PNG.
+    if png_bytes[:8] == _PNG_SIG and png_bytes[12:16] == b"IHDR":
+        px_w, px_h = struct.unpack(">II", png_bytes[16:24])
+    else:
+        from PIL import Image as PILImage
+        px_w, px_h = PILImage.open(BytesIO(png_bytes)).size
     aspect = px_h / px_w if px_w > 0 else 0.64
     height_pt = width_pt * aspect
 
@@ -2815,6 +3406,51 @@ def png_to_rl_image(png_bytes: bytes, width_pt: float):
     return img
 
 
+# ── Rendered PNG cache ────────────────────────────────────────────────
+# A wkhtmltoimage run is a process spawn plus a full page render, so each
+# distinct (svg, width) is converted once and the bytes reused — both for
+# figures repeated within a paper and across papers. Keys are 16-byte
+# digests so the cache doesn't pin every SVG source in memory.
+_PNG_CACHE      = OrderedDict()
+_PNG_CACHE_MAX  = 128
+_PNG_CACHE_LOCK = threading.Lock()
+
+def _png_for(svg_str, target_px):
+    if not _WKHTML_AVAILABLE:
+        return None
+    key = hashlib.blake2b(f"{target_px}|{svg_str}".encode("utf-8"),
+                          digest_size=16).digest()
+    with _PNG_CACHE_LOCK:
+        png = _PNG_CACHE.get(key)
+        if png is not None:
+            _PNG_CACHE.move_to_end(key)
+            return png
+    png = svg_to_png_bytes(svg_str, target_width_px=target_px)
+    if png:
+        with _PNG_CACHE_LOCK:
+            _PNG_CACHE[key] = png
+            while len(_PNG_CACHE) > _PNG_CACHE_MAX:
+                _PNG_CACHE.popitem(last=False)
+    return png
+
+
+# Each conversion is a separate wkhtmltoimage process, so threads are
+# enough to run them side by side — the GIL is released while waiting.
+_RENDER_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                                  thread_name_prefix="render")
+
+def _prewarm_diagrams(diagrams, width_pt):
+    """Convert every distinct diagram up front so the build loop only
+    looks up PNG bytes."""
+    target_px = int(width_pt * 2.2)
+    svgs = {v for v in diagrams.values() if v}
+    if len(svgs) == 1:
+        _png_for(svgs.pop(), target_px)
+        return
+    for fut in [_RENDER_POOL.submit(_png_for, svg, target_px) for svg in svgs]:
+        fut.result()
+
+
 # ── Master function: SVG string → best available PDF flowable ─────────
 def svg_to_best_image(svg_str: str, width_pt: float = 380):
     """
@@ -2823,7 +3459,7 @@ def svg_to_best_image(svg_str: str, width_pt: float = 380):
     """
     # Try high-quality PNG path first
     target_px = int(width_pt * 2.2)  # 2.2x gives crisp output at half the size
-    png_bytes = svg_to_png_bytes(svg_str, target_width_px=target_px)
+    png_bytes = _png_for(svg_str, target_px)
     if png_bytes:
         return png_to_rl_image(png_bytes, width_pt)
 
@@ -3213,6 +3849,179 @@ def svg_to_rl_image(svg_str: str, width_pt: float = 380):
 # ═══════════════════════════════════════════════════════════════════════
 # FLASK ROUTES
 # ═══════════════════════════════════════════════════════════════════════
+# PDF rendering is CPU-heavy; a small shared pool bounds how many builds
+# run at once so a burst of downloads can't starve Gemini-bound requests
+# or hold more ReportLab documents in memory than PDF_CONCURRENCY allows.
+_PDF_CONCURRENCY = int(os.environ.get("PDF_CONCURRENCY", "0")) or os.cpu_count() or 4
+_PDF_POOL = ThreadPoolExecutor(max_workers=_PDF_CONCURRENCY, thread_name_prefix="pdf")
+
+# Upper bound on paper + answer-key text a single download may render,
+# in UTF-8 bytes (Telugu/Hindi text is 3 bytes per character).
+_MAX_PAPER_BYTES = int(os.environ.get("MAX_PAPER_BYTES", str(256 * 1024)))
+
+def _utf8_len(s):
+    return len(s.encode("utf-8", "surrogatepass"))
+
+_PDF_SPOOL_MAX = 256 * 1024
+
+# Download filenames: each run of whitespace, control, path-separator or
+# Windows-reserved characters becomes one "_" in a single pass. Non-ASCII
+# text (Telugu/Hindi subject names) is left alone.
+_UNSAFE_FN = re.compile(r'[\s\x00-\x1f\x7f/\\:*?"<>|]+')
+
+# Teachers regenerate with the same settings constantly; identical prompts
+# are served from memory instead of spending Gemini quota again. With
+# REDIS_URL set, entries are also shared across workers and restarts.
+_PAPER_CACHE      = OrderedDict()
+_PAPER_CACHE_MAX  = 512
+_PAPER_CACHE_LOCK = threading.Lock()
+_PAPER_CACHE_TTL  = int(os.environ.get("PAPER_CACHE_TTL", "86400"))
+
+def _prompt_key(prompt, quality=None):
+    # The configured model preference is part of the key so switching
+    # models doesn't keep serving papers written by the old one. It is
+    # not the discovered model list: a cache lookup must never wait on
+    # a model-listing call.
+    pref = "pro" if quality == "high" else _GEMINI_MODEL
+    h = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16)
+    h.update(b"|" + pref.encode("utf-8"))
+    return "gen:" + h.hexdigest()
+
+# Last good paper per request settings, kept without expiry and served
+# instead of a 502 when Gemini is down. Keyed on the form fields rather
+# than the prompt, so prompt wording changes don't orphan entries.
+_STALE_CACHE = OrderedDict()
+
+def _params_key(*params):
+    norm = "|".join(str(p or "").strip().lower() for p in params)
+    return "gen:last:" + hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest()
+
+def _lru_put(cache, key, text):
+    with _PAPER_CACHE_LOCK:
+        cache[key] = text
+        cache.move_to_end(key)
+        while len(cache) > _PAPER_CACHE_MAX:
+            cache.popitem(last=False)
+
+def _cache_get(key, cache=_PAPER_CACHE):
+    with _PAPER_CACHE_LOCK:
+        text = cache.get(key)
+        if text is not None:
+            cache.move_to_end(key)
+            return text
+    if _REDIS is not None:
+        try:
+            text = _REDIS.get(key)
+        except Exception:
+            text = None
+        if text:
+            _lru_put(cache, key, text)
+            return text
+    return None
+
+def _cache_put(key, text, cache=_PAPER_CACHE, ttl=_PAPER_CACHE_TTL):
+    _lru_put(cache, key, text)
+    if _REDIS is not None:
+        try:
+            if ttl:
+                _REDIS.setex(key, ttl, text)
+            else:
+                _REDIS.set(key, text)
+        except Exception:
+            pass
+
+def _remember_paper(cache_key, stale_key, text):
+    if cache_key:
+        _cache_put(cache_key, text)
+    if stale_key:
+        _cache_put(stale_key, text, _STALE_CACHE, None)
+
+# examType → board name; an empty result falls back to the "board" field.
+_BOARD_RESOLVERS = {
+    "state-board": lambda state, exam: f"{state} State Board" if state else "",
+    "competitive": lambda state, exam: exam,
+}
+
+# Flags arrive as JSON booleans, numbers or form-style strings.
+_TRUTHY = frozenset({"true", "1", "yes", "on", "y", "t"})
+
+def _truthy(v):
+    if isinstance(v, bool):
+        return v
+    return v is not None and str(v).strip().lower() in _TRUTHY
+
+def _s(data, key, default=""):
+    """Stripped string field; numbers are stringified, missing/empty → default."""
+    v = data.get(key)
+    if not v:
+        return default
+    return v.strip() if isinstance(v, str) else str(v)
+
+def _json(obj):
+    return Response(_json_dumps(obj), mimetype="application/json")
+
+
+def _error_json(e):
+    # Tracebacks are logged, and only echoed to the client in debug mode.
+    app.logger.exception("request failed: %s", e)
+    body = {"success": False, "error": str(e)}
+    if app.debug:
+        body["trace"] = traceback.format_exc()
+    return _json(body), 500
+
+
+def _paper_payload(generated_text, api_error, used_fallback, board, subject, chapter,
+                   model=None):
+    paper, key = split_key(generated_text)
+    return {"success": True, "paper": paper, "answer_key": key,
+            "api_error": api_error, "used_fallback": used_fallback,
+            "board": board, "subject": subject, "chapter": chapter,
+            "model": model}
+
+
+def _sse(payload, event=None):
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {_json_dumps(payload).decode('utf-8')}\n\n"
+
+
+def _stale_payload(stale_key, api_error, board, subject, chapter):
+    text = _cache_get(stale_key, _STALE_CACHE) if stale_key else None
+    if not text:
+        return None
+    payload = _paper_payload(text, api_error, False, board, subject, chapter)
+    payload["used_stale_cache"] = True
+    return payload
+
+
+def _sse_paper(prompt, fallback, board, subject, chapter, cache_key=None, quality=None,
+               stale_key=None):
+    """Relay Gemini deltas as SSE frames, then a final `done` frame that
+    carries the same payload the non-streaming /generate returns."""
+    parts, api_error, info = [], None, {}
+    try:
+        for delta in stream_gemini(prompt, quality, info):
+            parts.append(delta)
+            yield _sse({"delta": delta})
+    except Exception as e:
+        api_error = str(e)
+
+    if api_error is None:
+        text = "".join(parts).strip()
+        if text:
+            _remember_paper(cache_key, stale_key, text)
+        yield _sse(_paper_payload(text, None, False, board, subject, chapter,
+                                  info.get("model")), event="done")
+    elif api_error in _FALLBACK_ERRORS:
+        yield _sse(_paper_payload(fallback(), api_error, True,
+                                  board, subject, chapter), event="done")
+    else:
+        stale = _stale_payload(stale_key, api_error, board, subject, chapter)
+        yield _sse(stale or {"success": False, "error": "AI generation failed.",
+                             "api_error": api_error,
+                             "suggestion": "Send use_fallback=true for a template paper."},
+                   event="done")
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -3221,88 +4030,111 @@ def index():
 @app.route("/generate", methods=["POST"])
 def generate():
     try:
-        data             = request.get_json(force=True) or {}
-        class_name       = (data.get("class") or "").strip()
-        subject          = (data.get("subject") or "").strip()
-        chapter          = (data.get("chapter") or "").strip()
-        marks            = (data.get("marks") or "100").strip()
-        difficulty       = (data.get("difficulty") or "Medium").strip()
-        state            = (data.get("state") or "").strip()
-        competitive_exam = (data.get("competitiveExam") or "").strip()
-        exam_type        = (data.get("examType") or "").strip()
-        suggestions      = (data.get("suggestions") or "").strip()
-
-        if exam_type == "state-board" and state:
-            board = f"{state} State Board"
-        elif exam_type == "competitive" and competitive_exam:
-            board = competitive_exam
-        else:
-            board = (data.get("board") or "AP State Board").strip()
+        data             = _json_loads(request.get_data() or b"{}") or {}
+        class_name       = _s(data, "class")
+        subject          = _s(data, "subject")
+        chapter          = _s(data, "chapter")
+        marks            = _s(data, "marks", "100")
+        difficulty       = _s(data, "difficulty", "Medium")
+        state            = _s(data, "state")
+        competitive_exam = _s(data, "competitiveExam")
+        exam_type        = _s(data, "examType")
+        suggestions      = _s(data, "suggestions")
+
+        resolve = _BOARD_RESOLVERS.get(exam_type)
+        board   = ((resolve(state, competitive_exam) if resolve else "")
+                   or _s(data, "board", "AP State Board"))
 
         if not subject and (data.get("scope") == "all" or data.get("all_chapters")):
             subject = "Mixed Subjects"
 
-        use_fallback = str(data.get("use_fallback", "false")).lower() in ("true", "1", "yes")
+        use_fallback = _truthy(data.get("use_fallback"))
+        stream       = _truthy(data.get("stream"))
+        quality      = _s(data, "quality").lower() or None
+        no_cache     = _truthy(data.get("no_cache", request.args.get("no_cache",
+                                                            request.args.get("nocache"))))
         prompt = data.get("prompt") or build_prompt(
             class_name, subject, chapter, board, exam_type, difficulty, marks, suggestions)
 
+        # no_cache ("generate again") skips the lookup, but the fresh paper
+        # still replaces the cached one.
+        cache_key = None if use_fallback else _prompt_key(prompt, quality)
+        cached    = _cache_get(cache_key) if cache_key and not no_cache else None
+        stale_key = None if (use_fallback or data.get("prompt")) else _params_key(
+            class_name, subject, chapter, board, exam_type, difficulty, marks)
+        if cached:
+            return _json(_paper_payload(cached, None, False, board, subject, chapter))
+
+        # Streaming: relay tokens as Server-Sent Events so the client sees
+        # progress at first-token latency instead of after the full paper.
+        if stream and not use_fallback and _GEMINI_READY:
+            fallback = lambda: build_local_paper(class_name, subject, chapter, marks, difficulty)
+            return Response(
+                stream_with_context(_sse_paper(prompt, fallback, board, subject, chapter,
+                                              cache_key, quality, stale_key)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
         generated_text = None
         api_error      = None
+        model          = None
 
-        if not use_fallback:
-            generated_text, api_error = call_gemini(prompt)
+        if not use_fallback and _GEMINI_READY:
+            generated_text, api_error, model = call_gemini(prompt, quality)
+            if generated_text:
+                _remember_paper(cache_key, stale_key, generated_text)
 
         if not generated_text:
-            if use_fallback or not GEMINI_KEY:
+            if use_fallback or not _GEMINI_READY or api_error in _FALLBACK_ERRORS:
                 generated_text = build_local_paper(class_name, subject, chapter, marks, difficulty)
                 use_fallback = True
             else:
-                return jsonify({"success": False, "error": "AI generation failed.",
+                stale = _stale_payload(stale_key, api_error, board, subject, chapter)
+                if stale:
+                    return _json(stale)
+                return _json({"success": False, "error": "AI generation failed.",
                                 "api_error": api_error,
                                 "suggestion": "Send use_fallback=true for a template paper."}), 502
 
-        paper, key = split_key(generated_text)
-        return jsonify({"success": True, "paper": paper, "answer_key": key,
-                        "api_error": api_error, "used_fallback": use_fallback,
-                        "board": board, "subject": subject, "chapter": chapter})
+        return _json(_paper_payload(generated_text, api_error, use_fallback,
+                                      board, subject, chapter, model))
     except Exception as e:
-        import traceback
-        return jsonify({"success": False, "error": str(e),
-                        "trace": traceback.format_exc()}), 500
+        return _error_json(e)
 
 
 @app.route("/download-pdf", methods=["POST"])
 def download_pdf():
     try:
-        data        = request.get_json(force=True) or {}
-        paper_text  = data.get("paper", "")
-        answer_key  = data.get("answer_key", "")
-        subject     = (data.get("subject") or "Question Paper").strip()
-        chapter     = (data.get("chapter") or "").strip()
-        board       = (data.get("board") or "").strip()
-        include_key = str(data.get("includeKey", "false")).lower() == "true"
-
+        data        = _json_loads(request.get_data() or b"{}") or {}
+        paper_text  = data.get("paper") or ""
+        answer_key  = data.get("answer_key") or ""
         if not paper_text.strip():
-            return jsonify({"success": False, "error": "No paper text provided"}), 400
+            return _json({"success": False, "error": "No paper text provided"}), 400
+        # A UTF-8 character is at most 4 bytes, so short text skips the encode.
+        n_chars = len(paper_text) + len(answer_key)
+        if n_chars * 4 > _MAX_PAPER_BYTES and (
+                n_chars > _MAX_PAPER_BYTES
+                or _utf8_len(paper_text) + _utf8_len(answer_key) > _MAX_PAPER_BYTES):
+            return _json({"success": False, "error": "Paper text too large"}), 413
+
+        subject     = _s(data, "subject", "Question Paper")
+        chapter     = _s(data, "chapter")
+        board       = _s(data, "board")
+        include_key = _truthy(data.get("includeKey"))
 
         diagrams = {}
-        if GEMINI_KEY and GENAI_AVAILABLE:
+        if _GEMINI_READY:
             # Collect diagram descriptions from both paper and answer key
             full_text = paper_text + "\n" + (answer_key or "")
             diag_descs = re.findall(
                 r'\[DIAGRAM:\s*([^\]]+)\]|\[draw\s+([^\]]+)\]',
                 full_text, re.IGNORECASE)
-            unique_descs = []
-            seen = set()
-            for d1, d2 in diag_descs:
-                desc = (d1 or d2).strip()
-                if desc and desc not in seen:
-                    seen.add(desc)
-                    unique_descs.append(desc)
+            # dict.fromkeys de-duplicates while keeping first-seen order
+            unique_descs = [d for d in dict.fromkeys((d1 or d2).strip()
+                                                     for d1, d2 in diag_descs) if d]
 
             # Generate all diagrams in parallel for speed
             if unique_descs:
-                from concurrent.futures import ThreadPoolExecutor, as_completed
                 with ThreadPoolExecutor(max_workers=min(4, len(unique_descs))) as ex:
                     futures = {ex.submit(generate_diagram_svg, d): d for d in unique_descs}
                     for future in as_completed(futures):
@@ -3314,44 +4146,68 @@ def download_pdf():
                         except Exception:
                             pass
 
-        pdf_bytes = create_exam_pdf(
-            paper_text, subject, chapter,
+        # Small PDFs stay in memory; big ones spill to disk instead of
+        # sitting in the worker's heap while the response is streamed.
+        pdf_buf = tempfile.SpooledTemporaryFile(max_size=_PDF_SPOOL_MAX)
+        _PDF_POOL.submit(
+            create_exam_pdf, paper_text, subject, chapter,
             board=board, answer_key=answer_key,
-            include_key=include_key, diagrams=diagrams)
+            include_key=include_key, diagrams=diagrams, out=pdf_buf).result()
+        # create_exam_pdf hands the buffer back rewound, so measure from
+        # the end before rewinding again for send_file.
+        pdf_buf.seek(0, 2)
+        size = pdf_buf.tell()
+        pdf_buf.seek(0)
 
         parts    = [p for p in [board, subject, chapter] if p]
-        filename = ("_".join(parts) + ".pdf").replace(" ", "_").replace("/", "-")
-        return send_file(BytesIO(pdf_bytes), as_attachment=True,
+        filename = _UNSAFE_FN.sub("_", "_".join(parts)).strip("._") + ".pdf"
+        resp = send_file(pdf_buf, as_attachment=True,
                          download_name=filename, mimetype="application/pdf")
+        resp.content_length = size
+        return resp
     except Exception as e:
-        import traceback
-        return jsonify({"success": False, "error": str(e),
-                        "trace": traceback.format_exc()}), 500
+        return _error_json(e)
 
 
+# Serialised once discovery has settled (or Gemini is off). A failed
+# discovery is only reused for a few seconds, so frequent load-balancer
+# probes retry the model listing at most once per _HEALTH_RETRY.
+_health_body  = None
+_health_until = 0.0
+_HEALTH_RETRY = 10.0
+
 @app.route("/health")
 def health():
-    configured = bool(GEMINI_KEY and GENAI_AVAILABLE)
-    models     = discover_models() if configured else []
-    return jsonify({"status": "ok",
-                    "gemini": "configured" if configured else "not configured",
-                    "models_available": models})
+    global _health_body, _health_until
+    if _health_body is None or time.monotonic() >= _health_until:
+        models = discover_models() if _GEMINI_READY else []
+        _health_body = _json_dumps({"status": "ok",
+                                    "gemini": "configured" if _GEMINI_READY else "not configured",
+                                    "models_available": models})
+        settled = not _GEMINI_READY or _discovered_models
+        _health_until = float("inf") if settled else time.monotonic() + _HEALTH_RETRY
+    return Response(_health_body, mimetype="application/json")
 
 
 @app.route("/chapters")
 def chapters():
     try:
-        data_path = _DATA_DIR / "curriculum.json"
-        if not data_path.exists():
-            return jsonify({"success": False, "error": "curriculum.json not found"})
-        with open(data_path, encoding="utf-8") as f:
-            curriculum = json.load(f)
-        cls = request.args.get("class") or request.args.get("cls")
-        if cls and cls in curriculum:
-            return jsonify({"success": True, "data": curriculum[cls]})
-        return jsonify({"success": True, "data": curriculum})
+        # Served from the copy parsed at import — the file is static for
+        # the life of the process.
+        if not _CURRICULUM:
+            return _json({"success": False, "error": "curriculum.json not found"})
+        if request.if_none_match.contains_weak(_CURRICULUM_ETAG):
+            resp = app.response_class(status=304)
+        else:
+            cls  = request.args.get("class") or request.args.get("cls")
+            body = _CHAPTERS_BODY.get(cls) or _CHAPTERS_BODY[None]
+            resp = Response(body, mimetype="application/json")
+        resp.set_etag(_CURRICULUM_ETAG)
+        resp.cache_control.public  = True
+        resp.cache_control.max_age = 3600
+        return resp
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)})
+        return _json({"success": False, "error": str(e)})
 
 
 if __name__ == "__main__":
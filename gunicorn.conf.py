@@ -0,0 +1,20 @@
+# Gunicorn settings for production (see Procfile). `python app.py` still
+# runs the Flask development server for local work.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '3000')}"
+
+# Gemini calls spend seconds waiting on the network, so each worker runs
+# a thread pool instead of handling one request at a time.
+workers      = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads      = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# Import app.py once in the master: the curriculum, fonts and pre-built
+# /chapters bodies are then shared copy-on-write by every worker. The
+# Gemini SDK is imported lazily, so no client is created before the fork.
+preload_app = True
+
+timeout   = 120
+keepalive = 5
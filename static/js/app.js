@@ -8,6 +8,7 @@ let curriculumData   = {};
 let currentPaper     = '';
 let currentAnswerKey = '';
 let currentMeta      = {};
+let lastGenerated    = ''; // settings of the last paper shown, to spot "generate again"
 
 // Current competitive scope state
 let compScope = 'topic'; // 'topic' | 'subject' | 'all'
@@ -442,6 +443,34 @@ window.switchPreviewTab = function(tab, btn) {
 };
 
 // ── Generate ──────────────────────────────────────────────────────────
+// /generate streams Server-Sent Events when asked to: `data` frames carry
+// {delta}, and a final `event: done` frame carries the full JSON result.
+async function readPaperStream(res, onDelta) {
+  const reader  = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = '', result = null;
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let idx;
+    while ((idx = buf.indexOf('\n\n')) !== -1) {
+      const frame = buf.slice(0, idx);
+      buf = buf.slice(idx + 2);
+      let event = 'message', data = '';
+      frame.split('\n').forEach(line => {
+        if (line.startsWith('event:'))     event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      });
+      if (!data) continue;
+      const msg = JSON.parse(data);
+      if (event === 'done') result = msg;
+      else if (msg.delta)   onDelta(msg.delta);
+    }
+  }
+  return result || { success: false, error: 'Generation stream ended unexpectedly' };
+}
+
 async function generatePaper() {
   const examType = document.getElementById('examType')?.value;
   if (!examType) { showToast('Please select a paper type first'); return; }
@@ -493,12 +522,26 @@ async function generatePaper() {
     payload.scope = compScope;
   }
 
+  // The server caches papers per settings; generating again with the same
+  // settings means the teacher wants a new paper, so skip the cache.
+  const settingsKey = JSON.stringify(payload);
+  const fresh = settingsKey === lastGenerated;
+
   showLoading(true, 'Crafting your paper…');
   setHint('Generating — usually 20-45 seconds…');
 
   try {
-    const res    = await fetch('/generate', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload) });
-    const result = await res.json();
+    const res = await fetch('/generate', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ ...payload, stream: true, no_cache: fresh }) });
+    let result;
+    if ((res.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+      let received = 0;
+      result = await readPaperStream(res, delta => {
+        received += delta.length;
+        setHint(`Receiving paper… ${received.toLocaleString()} characters`);
+      });
+    } else {
+      result = await res.json();
+    }
     showLoading(false);
 
     if (!result.success) {
@@ -509,6 +552,7 @@ async function generatePaper() {
 
     currentPaper     = result.paper     || '';
     currentAnswerKey = result.answer_key || '';
+    lastGenerated    = settingsKey;
 
     const boardText = result.board || payload.state || payload.competitiveExam || '';
     currentMeta = { board: boardText, subject: payload.subject || result.subject || '', chapter: payload.chapter || result.chapter || 'Full Syllabus', marks, difficulty };